@@ -1,13 +1,19 @@
-from flask import Flask, render_template, flash, request, redirect, send_from_directory, jsonify
+from flask import Flask, render_template, flash, request, redirect, send_from_directory, jsonify, json, abort, Response, stream_with_context
 from flask_marshmallow import Marshmallow
 from flask_cors import CORS, cross_origin
 from marshmallow import fields
-from models import db, Landlord, Property, Alias, CodeCase, Eviction
+from models import db, Landlord, Property, Alias
 from constants import SEARCH_DEFAULT_MAX_RESULTS
-from datetime import date, timedelta
 import os
+import math
 import utils
 import constants
+import autocomplete
+import spatial
+import tiles
+import response_cache
+import serialization
+import export
 
 
 app = Flask(__name__,static_folder='frontend/build',static_url_path='')
@@ -98,11 +104,26 @@ def not_found(e):
 @app.route('/api/landlords/top/', methods=['GET'])
 @cross_origin()
 def get_top_landlords():
-    pageSize = int(request.args.get('pageSize')) if request.args.get('pageSize') else constants.DEFAULT_PAGE_SIZE
-    pageNumber = int(request.args.get('pageNumber')) if request.args.get('pageNumber') else constants.DEFAULT_PAGE_NUMBER
+    try:
+        pageSize = int(request.args.get('pageSize')) if request.args.get('pageSize') else constants.DEFAULT_PAGE_SIZE
+        pageNumber = int(request.args.get('pageNumber')) if request.args.get('pageNumber') else constants.DEFAULT_PAGE_NUMBER
+    except ValueError:
+        return jsonify({"error": "pageSize and pageNumber must be whole numbers."}), 400
+    if pageSize < 1 or pageNumber < 1:
+        return jsonify({"error": "pageSize and pageNumber must be at least 1."}), 400
     sortBy = request.args.get('sortBy').lower() if request.args.get('sortBy') else constants.DEFAULT_SORT_BY
     sortDirection = request.args.get('sortDirection') if request.args.get('sortDirection') else constants.DEFAULT_SORT_DIRECTION
 
+    cursor = request.args.get('cursor')
+
+    # Passing a cursor (empty for the first page) opts in to keyset pagination
+    if cursor is not None:
+        try:
+            landlords_paginated = utils.get_ranked_landlords_after(sortBy, sortDirection, cursor, pageSize)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"total_results": landlords_paginated.total, "landlords": landlords_paginated.items, "next_cursor": landlords_paginated.next_cursor})
+
     landlords_paginated = utils.get_ranked_landlords(sortBy, sortDirection, pageNumber, pageSize)
 
     return jsonify({"total_results": landlords_paginated.total, "landlords": landlords_paginated.items})
@@ -110,88 +131,126 @@ def get_top_landlords():
 
 @app.route('/api/landlords/<group_id>', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord(group_id):
-    return LANDLORD_SCHEMA.jsonify(Landlord.query.filter_by(group_id=group_id).first())
+    return LANDLORD_SCHEMA.jsonify(utils.landlord_query(group_id).first())
+
+
+def get_bulk_request_ids():
+    response_json = request.get_json()
+    landlord_ids = response_json["ids"] if "ids" in response_json else []
+    if len(landlord_ids) > constants.BULK_REQUEST_MAX_IDS:
+        abort(413, f"At most {constants.BULK_REQUEST_MAX_IDS} ids can be requested at once.")
+    return landlord_ids
 
 
 @app.route('/api/landlords/', methods=['POST'])
 @cross_origin()
 def get_landlords_bulk():
-    response_json = request.get_json()
-    landlord_ids = response_json["ids"] if "ids" in response_json else []
+    landlord_ids = get_bulk_request_ids()
     landlords = Landlord.query.filter(Landlord.group_id.in_(landlord_ids)).all()
-    aliases = Alias.query.filter(Alias.group_id.in_(landlord_ids)).all()
-    landlord_map = {}
-    for landlord in landlords:
-        landlord_map[landlord.group_id] = landlord.as_dict()
-        alias_names = ', '.join([alias.name for alias in aliases if alias.group_id == landlord.group_id and alias.name != landlord.name])
-        landlord_map[landlord.group_id]["aliases"] = alias_names
+    aliases = Alias.query.with_entities(Alias.group_id, Alias.name).filter(Alias.group_id.in_(landlord_ids))
 
-    return jsonify(landlord_map)
+    aliases_by_group = {}
+    for group_id, alias_name in aliases:
+        aliases_by_group.setdefault(group_id, []).append(alias_name)
+
+    def generate():
+        yield '{'
+        for index, landlord in enumerate(landlords):
+            landlord_dict = landlord.as_dict()
+            alias_names = ', '.join([name for name in aliases_by_group.get(landlord.group_id, []) if name != landlord.name])
+            landlord_dict["aliases"] = alias_names
+            separator = ',' if index > 0 else ''
+            yield f'{separator}{json.dumps(landlord.group_id)}:{json.dumps(landlord_dict)}'
+        yield '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.route('/api/landlords/grades', methods=['POST'])
+@cross_origin()
+def get_landlord_grades_bulk():
+    landlord_ids = get_bulk_request_ids()
+    return jsonify(utils.get_landlord_grades_bulk(landlord_ids))
 
 
 @app.route('/api/landlords/<group_id>/aliases', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_aliases(group_id):
-    aliases = Alias.query.filter_by(group_id=group_id).all()
-    return ALIASES_SCHEMA.jsonify(aliases)
+    aliases = utils.landlord_aliases_query(group_id)
+    return serialization.json_array_response(aliases, ALIASES_SCHEMA)
 
 
 @app.route('/api/landlords/<group_id>/code_violations', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_code_violations(group_id):
-    one_year_ago = date.today() - timedelta(days=365) 
-    code_cases = CodeCase.query.filter(CodeCase.case_type == constants.CODE_VIOLATIONS_TYPE)\
-        .filter(CodeCase.apply_date >= one_year_ago) \
-        .join(Property, Property.parcel_id==CodeCase.parcel_id)\
-        .filter(Property.group_id == group_id)\
-        .all()
-    return CODE_CASES_SCHEMA.jsonify(code_cases)
+    code_cases = utils.landlord_code_cases_query(group_id, [constants.CODE_VIOLATIONS_TYPE])
+    return serialization.json_array_response(code_cases, CODE_CASES_SCHEMA)
 
 
 @app.route('/api/landlords/<group_id>/evictions', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_evictions(group_id):
-    one_year_ago = date.today() - timedelta(days=365) 
-    evictions = Eviction.query.join(Alias, Alias.name == Eviction.matched_name)\
-        .filter(Eviction.case_date >= one_year_ago)\
-        .filter_by(group_id=group_id)
-    return EVICTIONS_SCHEMA.jsonify(evictions)
+    evictions = utils.landlord_evictions_query(group_id)
+    return serialization.json_array_response(evictions, EVICTIONS_SCHEMA)
 
 
 @app.route('/api/landlords/<group_id>/grades', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_grades(group_id):
-    landlord = Landlord.query.filter_by(group_id=group_id).first().as_dict()
-    city_stats = utils.get_city_average_stats()
-    landlord_stats = utils.get_landlord_stats(group_id)
-
-    grades = utils.add_grade_and_color(landlord_stats, city_stats)
-    grades.update(landlord)
-    grades.update(utils.calculate_landlord_score(grades))
+    grades = utils.get_landlord_grades(group_id)
+    if grades is None:
+        return jsonify({"error": "Landlord not found."}), 404
     return jsonify(grades)
 
 
+@app.route('/api/landlords/<group_id>/profile', methods=['GET'])
+@cross_origin()
+@response_cache.cached_response
+def get_landlord_profile(group_id):
+    sections = request.args.get('fields').split(',') if request.args.get('fields') else constants.LANDLORD_PROFILE_SECTIONS
+    unknown_sections = [section for section in sections if section not in constants.LANDLORD_PROFILE_SECTIONS]
+    if unknown_sections:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown_sections)}."}), 400
+
+    section_schemas = {
+        "aliases": ALIASES_SCHEMA,
+        "code_violations": CODE_CASES_SCHEMA,
+        "evictions": EVICTIONS_SCHEMA,
+        "properties": PROPERTIES_SCHEMA,
+    }
+    profile = utils.get_landlord_profile(group_id, sections, lambda query, section: serialization.dump_rows(query, section_schemas[section]))
+    if profile is None:
+        return jsonify({"error": "Landlord not found."}), 404
+
+    profile["landlord"] = LANDLORD_SCHEMA.dump(profile["landlord"])
+    return Response(serialization.encode_json({section: profile[section] for section in sections}), mimetype='application/json')
+
+
 @app.route('/api/landlords/<group_id>/properties', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_properties(group_id):
-    properties = Property.query.filter_by(group_id=group_id).all()
-    return PROPERTIES_SCHEMA.jsonify(properties)
+    properties = utils.landlord_properties_query(group_id)
+    return serialization.json_array_response(properties, PROPERTIES_SCHEMA)
 
 
 @app.route('/api/landlords/<group_id>/unsafe_unfit', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_landlord_unsafe_unfit_properties(group_id):
-    one_year_ago = date.today() - timedelta(days=365) 
-    properties = Property.query.filter(Property.group_id == group_id).join(CodeCase, Property.parcel_id==CodeCase.parcel_id) \
-        .filter(CodeCase.case_type == constants.UNSAFE_UNFIT_TYPE) \
-        .filter(CodeCase.apply_date >= one_year_ago) \
-        .all()
-    return PROPERTIES_SCHEMA.jsonify(properties)
+    properties = utils.landlord_unsafe_unfit_properties_query(group_id)
+    return serialization.json_array_response(properties, PROPERTIES_SCHEMA)
 
 
 @app.route('/api/stats', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_city_stats():
     stats = utils.get_city_average_stats()
     return stats
@@ -202,19 +261,69 @@ def get_city_stats():
 def get_search_results():
     max_results = request.args.get('max_results') if request.args.get('max_results') else SEARCH_DEFAULT_MAX_RESULTS
     search_string = request.args.get('query') if request.args.get('query') else ""
-    return PROPERTIES_SCHEMA.jsonify(utils.perform_search(search_string, max_results).all())
+    return serialization.json_array_response(utils.perform_search(search_string, max_results), PROPERTIES_SCHEMA)
     
 
+@app.route('/api/autocomplete', methods=['GET'])
+@cross_origin()
+def get_autocomplete_suggestions():
+    try:
+        max_results = int(request.args.get('max_results')) if request.args.get('max_results') else constants.AUTOCOMPLETE_DEFAULT_MAX_RESULTS
+    except ValueError:
+        return jsonify({"error": "max_results must be a whole number."}), 400
+    search_string = request.args.get('query') if request.args.get('query') else ""
+    return jsonify(autocomplete.get_suggestions(search_string, min(max_results, constants.AUTOCOMPLETE_MAX_RESULTS)))
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@cross_origin()
+def get_map_tile(z, x, y):
+    tile = tiles.get_tile(z, x, y)
+    if tile is None:
+        return jsonify({"error": f"Tiles are available for zoom levels {constants.MAP_TILE_MIN_ZOOM} to {constants.MAP_TILE_MAX_ZOOM}."}), 404
+
+    etag, body = tile
+    response = Response(body, mimetype='application/geo+json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = constants.MAP_TILE_CACHE_MAX_AGE_SECONDS
+    return response.make_conditional(request)
+
+
+@app.route('/api/export/landlords.<export_format>', methods=['GET'])
+@cross_origin()
+def export_landlords(export_format):
+    if export_format not in export.EXPORT_MIMETYPES:
+        return jsonify({"error": f"Exports are available as {', '.join(export.EXPORT_MIMETYPES)}."}), 404
+    try:
+        return export.get_export_response(export_format)
+    except export.ExportUnavailable as e:
+        return jsonify({"error": str(e)}), 501
+
+
+@app.route('/api/properties/bbox', methods=['GET'])
+@cross_origin()
+def get_properties_in_bbox():
+    try:
+        min_lat = float(request.args['minLat'])
+        max_lat = float(request.args['maxLat'])
+        min_lon = float(request.args['minLon'])
+        max_lon = float(request.args['maxLon'])
+        zoom = float(request.args.get('zoom')) if request.args.get('zoom') else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "minLat, maxLat, minLon and maxLon must be numbers."}), 400
+    if not all(math.isfinite(value) for value in [min_lat, max_lat, min_lon, max_lon]) or (zoom is not None and not math.isfinite(zoom)):
+        return jsonify({"error": "minLat, maxLat, minLon, maxLon and zoom must be finite."}), 400
+    return jsonify(spatial.get_properties_in_bbox(min_lat, max_lat, min_lon, max_lon, zoom))
+
+
 @app.route('/api/properties/<id>', methods=['GET'])
 @cross_origin()
+@response_cache.cached_response
 def get_property(id):
     property_obj = Property.query.get(id).as_dict()
     print(property_obj)
-    one_year_ago = date.today() - timedelta(days=365) 
-    unsafe_unfit = CodeCase.query.filter(CodeCase.parcel_id == property_obj["parcel_id"])\
-        .filter(CodeCase.case_type == constants.UNSAFE_UNFIT_TYPE) \
-        .filter(CodeCase.apply_date >= one_year_ago) \
-        .first()
+    unsafe_unfit = utils.property_unsafe_unfit_cases_query(property_obj["parcel_id"]).first()
 
     if unsafe_unfit:
         property_obj["unsafe_unfit_case_number"] = unsafe_unfit.case_number
@@ -0,0 +1,78 @@
+from bisect import bisect_left
+from models import Property, Alias
+import constants
+import re
+import utils
+
+
+class PrefixIndex:
+    def __init__(self, entries):
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.keys = [key for key, suggestion in entries]
+        self.suggestions = [suggestion for key, suggestion in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, prefix, max_results):
+        results = []
+        seen = set()
+        position = bisect_left(self.keys, prefix)
+
+        while position < len(self.keys) and len(results) < max_results:
+            if not self.keys[position].startswith(prefix):
+                break
+
+            suggestion = self.suggestions[position]
+            identity = (suggestion["type"], suggestion["property_id"], suggestion["group_id"])
+            if identity not in seen:
+                seen.add(identity)
+                results.append(suggestion)
+            position = position + 1
+
+        return results
+
+
+# Used for both index keys and queries. Lowercased first, since replace_ordinals only
+# recognizes lowercase suffixes ("2nd" but not "2ND")
+def normalize(text):
+    text = re.sub(r'\s+', ' ', text).strip().lower()
+    return utils.replace_ordinals(text)
+
+
+def get_property_entries():
+    properties = Property.query.with_entities(Property.id, Property.address, Property.group_id)
+    for property_id, address, group_id in properties:
+        suggestion = {"type": "property", "label": address, "group_id": group_id, "property_id": property_id}
+        key = normalize(address)
+        yield (key, suggestion)
+
+        # Also index the street without the house number, so "lark st" finds "12 LARK ST"
+        house_number, _, street = key.partition(' ')
+        if house_number.isdigit() and street:
+            yield (street, suggestion)
+
+
+def get_alias_entries():
+    aliases = Alias.query.with_entities(Alias.name, Alias.group_id)
+    for name, group_id in aliases:
+        yield (normalize(name), {"type": "landlord", "label": name, "group_id": group_id, "property_id": None})
+
+
+def build_index():
+    return PrefixIndex(list(get_property_entries()) + list(get_alias_entries()))
+
+
+# Each worker builds its prefix index on first use
+_index_cache = utils.GenerationCache(build_index, constants.AUTOCOMPLETE_INDEX_TTL_SECONDS)
+
+
+def get_index():
+    return _index_cache.get()
+
+
+def get_suggestions(text, max_results):
+    prefix = normalize(text)
+    if not prefix:
+        return []
+    return get_index().search(prefix, max_results)
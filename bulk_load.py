@@ -0,0 +1,223 @@
+import logging
+import re
+import tempfile
+from dateutil import parser as date_parser
+from sqlalchemy import text, Date, DateTime
+from models import db, DataGeneration, RowHash
+import constants
+import utils
+
+
+##########################################
+# Bulk Loading
+#
+# Shared by the populate scripts to replace the full contents of tables.
+# On Postgres, rows are spooled to disk in COPY text format and streamed with
+# COPY ... FROM STDIN into bare shadow copies of the live tables. The shadow
+# tables are indexed once they're full and then renamed into place in one
+# short transaction, so readers are never blocked behind the load. Other
+# databases (e.g. SQLite) fall back to deleting and re-inserting with batched
+# executemany inserts.
+#
+# Every load bumps the data generation, which the app's caches watch.
+##########################################
+
+
+def get_load_columns(table):
+    # Autoincrementing IDs are left for the database to assign
+    return [column.name for column in table.columns if column.autoincrement is not True]
+
+
+def get_date_columns(table):
+    return {column.name for column in table.columns if isinstance(column.type, (Date, DateTime))}
+
+
+def parse_load_value(value, is_date):
+    # COPY parses date strings itself, but SQLAlchemy's SQLite dialect only accepts datetime objects
+    if is_date and isinstance(value, str):
+        return date_parser.parse(value) if value.strip() else None
+    return value
+
+
+def get_insert_row(row, columns, date_columns):
+    return {column: parse_load_value(row.get(column), column in date_columns) for column in columns}
+
+
+def format_copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_copy_row(row, columns):
+    return '\t'.join(format_copy_value(row.get(column)) for column in columns) + '\n'
+
+
+def get_shadow_table_name(table):
+    return f"{table.name}_shadow"
+
+
+def get_retired_table_name(table):
+    return f"{table.name}_retired"
+
+
+def create_shadow_table(table):
+    # Without indexes, which are built in one pass after the COPY rather than updated row by row
+    shadow_table = get_shadow_table_name(table)
+    db.session.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+    db.session.execute(f"CREATE TABLE {shadow_table} (LIKE {table.name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+
+
+def get_constraint_definitions(table_name):
+    # Primary key, unique and exclusion constraints, which are backed by indexes
+    return db.session.execute(text("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = CAST(:table_name AS regclass) AND contype IN ('p', 'u', 'x')"),
+                              {"table_name": table_name}).fetchall()
+
+
+def get_index_definitions(table_name):
+    # Indexes that don't back a constraint
+    return db.session.execute(text("SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) FROM pg_index "
+                                   "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+                                   "WHERE pg_index.indrelid = CAST(:table_name AS regclass) "
+                                   "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE pg_constraint.conindid = pg_index.indexrelid)"),
+                              {"table_name": table_name}).fetchall()
+
+
+def create_shadow_indexes(table):
+    # Copies of the live table's constraints and indexes under shadow names. swap_in_shadow_table
+    # gives them the live names back
+    shadow_table = get_shadow_table_name(table)
+    for constraint_name, definition in get_constraint_definitions(table.name):
+        db.session.execute(f"ALTER TABLE {shadow_table} ADD CONSTRAINT {constraint_name}_shadow {definition}")
+    for index_name, definition in get_index_definitions(table.name):
+        shadow_definition = re.sub(r'^CREATE (UNIQUE )?INDEX \S+ ON \S+ ',
+                                   lambda match: f"CREATE {match.group(1) or ''}INDEX {index_name}_shadow ON {shadow_table} ", definition)
+        db.session.execute(shadow_definition)
+
+
+def copy_records(tables, records):
+    columns = {table: get_load_columns(table) for table in tables}
+    spools = {table: tempfile.SpooledTemporaryFile(max_size=constants.BULK_LOAD_SPOOL_MAX_BYTES, mode='w+') for table in tables}
+    counts = {table: 0 for table in tables}
+    cursor = db.session.connection().connection.cursor()
+
+    try:
+        for table, row in records:
+            spools[table].write(format_copy_row(row, columns[table]))
+            counts[table] = counts[table] + 1
+
+        for table in tables:
+            spools[table].seek(0)
+            column_list = ', '.join(columns[table])
+            cursor.copy_expert(f"COPY {get_shadow_table_name(table)} ({column_list}) FROM STDIN", spools[table])
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+    return counts
+
+
+def get_index_names_by_definition(table_name):
+    # Keys index definitions with the index and table names stripped, so a shadow table's
+    # indexes can be matched up with the live table's
+    indexes = db.session.execute(text("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table_name"),
+                                 {"table_name": table_name})
+    return {re.sub(r'^CREATE (UNIQUE )?INDEX \S+ ON \S+ ', r'\1', indexdef): indexname for indexname, indexdef in indexes}
+
+
+def swap_in_shadow_table(table):
+    shadow_table = get_shadow_table_name(table)
+    retired_table = get_retired_table_name(table)
+
+    live_index_names = get_index_names_by_definition(table.name)
+    shadow_index_names = get_index_names_by_definition(shadow_table)
+
+    db.session.execute(f"ALTER TABLE {table.name} RENAME TO {retired_table}")
+    db.session.execute(f"ALTER TABLE {shadow_table} RENAME TO {table.name}")
+
+    # The shadow table shares the live table's ID sequences, which would be dropped along with it
+    for column in table.columns:
+        if column.autoincrement is not True:
+            continue
+        sequence = db.session.execute(text("SELECT pg_get_serial_sequence(:table_name, :column_name)"),
+                                      {"table_name": retired_table, "column_name": column.name}).scalar()
+        if sequence is not None:
+            db.session.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table.name}.{column.name}")
+
+    db.session.execute(f"DROP TABLE {retired_table}")
+
+    # Give the swapped-in indexes their original names back, so later index checks still find them
+    for definition, shadow_index_name in shadow_index_names.items():
+        if definition in live_index_names:
+            db.session.execute(f"ALTER INDEX {shadow_index_name} RENAME TO {live_index_names[definition]}")
+
+
+def swap_tables(tables, records):
+    for table in tables:
+        create_shadow_table(table)
+    counts = copy_records(tables, records)
+    for table in tables:
+        create_shadow_indexes(table)
+    db.session.commit()
+
+    # Only the renames need exclusive locks, and they're quick
+    db.session.execute(f"SET LOCAL lock_timeout = '{constants.TABLE_SWAP_LOCK_TIMEOUT}'")
+    for table in tables:
+        swap_in_shadow_table(table)
+
+    return counts
+
+
+def insert_records(tables, records):
+    columns = {table: get_load_columns(table) for table in tables}
+    date_columns = {table: get_date_columns(table) for table in tables}
+    batches = {table: [] for table in tables}
+    counts = {table: 0 for table in tables}
+
+    def flush(table):
+        if batches[table]:
+            db.session.execute(table.insert(), batches[table])
+            counts[table] = counts[table] + len(batches[table])
+            batches[table] = []
+
+    for table, row in records:
+        batches[table].append(get_insert_row(row, columns[table], date_columns[table]))
+        if len(batches[table]) >= constants.BULK_LOAD_BATCH_SIZE:
+            flush(table)
+
+    for table in tables:
+        flush(table)
+
+    return counts
+
+
+def replace_tables(tables, records):
+    for table in tables:
+        db.session.execute(table.delete())
+    return insert_records(tables, records)
+
+
+# Replaces every row in each model's table with `records`, an iterable of (model, row dict)
+# pairs, and commits. Returns the number of rows loaded per model.
+def load_tables(models, records):
+    tables = [model.__table__ for model in models]
+    table_records = ((model.__table__, row) for model, row in records)
+    DataGeneration.__table__.create(bind=db.engine, checkfirst=True)
+    RowHash.__table__.create(bind=db.engine, checkfirst=True)
+
+    if db.engine.dialect.name == "postgresql":
+        counts = swap_tables(tables, table_records)
+    else:
+        counts = replace_tables(tables, table_records)
+
+    # Content hashes from earlier incremental loads no longer describe these tables
+    db.session.query(RowHash).filter(RowHash.table_name.in_([table.name for table in tables])).delete(synchronize_session=False)
+
+    generation = utils.bump_data_generation(', '.join(table.name for table in tables))
+    db.session.commit()
+
+    for model in models:
+        logging.warning(f"Loaded {counts[model.__table__]} rows into {model.__tablename__}.")
+    logging.warning(f"Data generation is now {generation.id}.")
+
+    return {model: counts[model.__table__] for model in models}
@@ -3,8 +3,66 @@ DEFAULT_PAGE_NUMBER = 1
 DEFAULT_SORT_BY = "property_count"
 DEFAULT_SORT_DIRECTION = "desc"
 
+# Maps the sortBy values accepted by /api/landlords/top/ to landlord_scorecard or staging_landlord columns
+RANKING_SORT_COLUMNS = {
+    "grade": "score",
+    "property_count": "property_count",
+    "unit_count": "unit_count",
+    "eviction_count": "evictions_count",
+    "evictions_count": "evictions_count",
+    "code_violations_count": "code_violations_count",
+    "evictions_per_unit": "evictions_per_unit",
+    "code_violations_per_unit": "code_violations_per_unit",
+    "name": "name",
+    "address": "address",
+    "id": "id",
+}
+
 SEARCH_DEFAULT_MAX_RESULTS = 100
 
+# Number of distinct strings kept by each of the address normalization and parsing caches
+ADDRESS_CACHE_SIZE = 10000
+
+AUTOCOMPLETE_DEFAULT_MAX_RESULTS = 10
+AUTOCOMPLETE_MAX_RESULTS = 50
+# How long a worker serves its in-memory autocomplete index before rebuilding it from the database
+AUTOCOMPLETE_INDEX_TTL_SECONDS = 60 * 60
+
+# Size, in degrees, of the cells in each worker's in-memory grid of property locations
+SPATIAL_GRID_CELL_DEGREES = 0.005
+SPATIAL_INDEX_TTL_SECONDS = 60 * 60
+# /api/properties/bbox returns clusters instead of properties below this zoom level, or when more
+# than BBOX_MAX_PROPERTIES are in view. Clusters are laid out on a grid about this many cells across.
+SPATIAL_CLUSTER_MAX_ZOOM = 15
+BBOX_MAX_PROPERTIES = 500
+SPATIAL_CLUSTER_GRID_SIZE = 16
+
+# Map tiles are generated for these zoom levels; map clients should overzoom past the maximum
+MAP_TILE_MIN_ZOOM = 12
+MAP_TILE_MAX_ZOOM = 16
+MAP_TILE_MAX_LATITUDE = 85.0511
+MAP_TILE_CACHE_MAX_AGE_SECONDS = 5 * 60
+
+# Per-worker LRU of read-only API responses, bounded by the total size of their bodies. Clients may
+# reuse a response for max-age seconds before revalidating it with its ETag.
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_AGE_SECONDS = 60
+# Entries in a shared Redis cache expire on their own after this long
+RESPONSE_CACHE_SHARED_TTL_SECONDS = 24 * 60 * 60
+
+# Sections returned by /api/landlords/<group_id>/profile when no fields= are given
+LANDLORD_PROFILE_SECTIONS = ["landlord", "aliases", "code_violations", "evictions", "grades", "properties", "unsafe_unfit"]
+
+# Rows fetched from the database and encoded at a time by the streaming list endpoints
+SERIALIZATION_CHUNK_SIZE = 1000
+
+# Landlords read from the database and written at a time by /api/export/landlords.<format>
+EXPORT_BATCH_SIZE = 1000
+EXPORT_READ_CHUNK_BYTES = 64 * 1024
+
+# Largest number of group IDs accepted by the bulk landlord endpoints in one request
+BULK_REQUEST_MAX_IDS = 1000
+
 GRADE_COLORS = {
   'A': "2cba00",
   'B': "2cba00",
@@ -30,3 +88,18 @@ STATS_TO_SCALE = GRADE_COMPONENTS
 CODE_VIOLATIONS_TYPE = 'CODE ENFORCEMENT'
 UNSAFE_UNFIT_TYPE = 'UNSAFE & UNFIT'
 ROP_TYPE = 'ROP'
+
+# How often a worker checks whether a data refresh has bumped the data generation
+DATA_GENERATION_CHECK_SECONDS = 10
+
+# How long a worker keeps the city stats snapshot in memory before checking for a newer version
+CITY_STATS_CACHE_TTL_SECONDS = 300
+# `python refresh.py --if-stale` recomputes snapshots older than this, since the stats cover a rolling one-year window
+CITY_STATS_MAX_AGE_SECONDS = 24 * 60 * 60
+
+# Rows per executemany batch when bulk loading into databases without COPY support
+BULK_LOAD_BATCH_SIZE = 5000
+# Rows waiting to be COPYed into Postgres are kept in memory up to this size, then spilled to disk
+BULK_LOAD_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+# Longest a table swap waits for readers to let go of the live tables before giving up
+TABLE_SWAP_LOCK_TIMEOUT = '5s'
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Property, Alias, RowHash, DataGeneration
+import bulk_load
+import utils
+
+
+##########################################
+# Incremental Loading
+#
+# Alternative to bulk_load.load_tables for when only part of a source has
+# changed. Incoming rows are matched to stored rows by natural key and
+# compared by a hash of their content, and only the inserts, updates and
+# deletes are written. Natural keys that aren't unique (e.g. parcel IDs)
+# are compared as a multiset of rows. The hashes of the last rows loaded
+# this way live in the row_hash table; rows without a stored hash (e.g.
+# after a full load) count as updated.
+##########################################
+
+
+NATURAL_KEYS = {
+    "staging_landlord": "group_id",
+    "staging_property": "parcel_id",
+    "staging_alias": "name",
+    "eviction": "caseid",
+    "codecase": "case_id",
+}
+
+# Column used to work out which owner groups a changed row belongs to
+GROUP_COLUMNS = {
+    "staging_landlord": "group_id",
+    "staging_property": "group_id",
+    "staging_alias": "group_id",
+    "eviction": "matched_name",
+    "codecase": "parcel_id",
+}
+
+CHUNK_SIZE = 500
+
+
+class TableDelta:
+    def __init__(self, table_name, inserted, updated, deleted, group_values):
+        self.table_name = table_name
+        self.inserted = inserted
+        self.updated = updated
+        self.deleted = deleted
+        self.group_values = group_values
+
+    def __repr__(self):
+        return f"<TableDelta {self.table_name}: {len(self.inserted)} inserted, {len(self.updated)} updated, {len(self.deleted)} deleted>"
+
+
+def chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def get_natural_key(value):
+    return None if value is None else str(value)
+
+
+def get_content_hash(rows, columns):
+    # Rows sharing a natural key are hashed in sorted order, so their order in the source doesn't matter
+    contents = sorted(json.dumps([row.get(column) for column in columns], default=str) for row in rows)
+    return hashlib.sha256(json.dumps(contents).encode('utf-8')).hexdigest()
+
+
+def get_upsert_statement(table, key_column, columns):
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(table)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        return None
+
+    return statement.on_conflict_do_update(
+        index_elements=[key_column],
+        set_={column: statement.excluded[column] for column in columns if column != key_column.name})
+
+
+def is_unique_key(table):
+    key_column = table.columns[NATURAL_KEYS[table.name]]
+    return bool(key_column.primary_key or key_column.unique)
+
+
+def apply_table_delta(table, rows):
+    key_column = table.columns[NATURAL_KEYS[table.name]]
+    group_column = table.columns[GROUP_COLUMNS[table.name]]
+    columns = bulk_load.get_load_columns(table)
+    date_columns = bulk_load.get_date_columns(table)
+
+    # Incoming rows and stored (primary key, group value) pairs by natural key. Several rows can
+    # share a natural key (e.g. a parcel ID) unless the key column is unique
+    incoming = {}
+    for row in rows:
+        incoming.setdefault(get_natural_key(row.get(key_column.name)), []).append(row)
+
+    duplicate_keys = [key for key, key_rows in incoming.items() if len(key_rows) > 1]
+    if duplicate_keys and is_unique_key(table):
+        raise ValueError(f"{len(duplicate_keys)} {key_column.name} values appear more than once in the new {table.name} rows (e.g. {duplicate_keys[0]!r}), but {key_column.name} is unique.")
+
+    primary_key_column = list(table.primary_key.columns)[0]
+    stored = {}
+    for primary_key, key_value, group_value in db.session.query(primary_key_column, key_column, group_column).order_by(primary_key_column):
+        stored.setdefault(get_natural_key(key_value), []).append((primary_key, group_value))
+
+    stored_hashes = dict(db.session.query(RowHash.natural_key, RowHash.content_hash).filter(RowHash.table_name == table.name))
+    incoming_hashes = {key: get_content_hash(key_rows, columns) for key, key_rows in incoming.items()}
+
+    inserted = [key for key in incoming if key not in stored]
+    deleted = [key for key in stored if key not in incoming]
+    updated = [key for key in incoming if key in stored and stored_hashes.get(key) != incoming_hashes[key]]
+
+    group_values = set()
+    for key in deleted + updated:
+        group_values.update(group_value for primary_key, group_value in stored[key])
+    for key in inserted + updated:
+        group_values.update(row.get(group_column.name) for row in incoming[key])
+
+    def get_values(row):
+        return bulk_load.get_insert_row(row, columns, date_columns)
+
+    deleted_primary_keys = [primary_key for key in deleted for primary_key, group_value in stored[key]]
+    upsert = get_upsert_statement(table, key_column, columns) if is_unique_key(table) else None
+    if upsert is not None:
+        for primary_keys in chunks(deleted_primary_keys):
+            db.session.execute(table.delete().where(primary_key_column.in_(primary_keys)))
+        for batch in chunks([get_values(incoming[key][0]) for key in inserted + updated]):
+            db.session.execute(upsert, batch)
+    else:
+        # Rows sharing an updated natural key are rewritten in place, in order, keeping their IDs;
+        # stored rows left over are deleted and incoming rows left over are inserted
+        update_params = []
+        inserted_rows = [get_values(row) for key in inserted for row in incoming[key]]
+        for key in updated:
+            for (primary_key, group_value), row in zip(stored[key], incoming[key]):
+                update_params.append(dict(_primary_key=primary_key, **get_values(row)))
+            deleted_primary_keys += [primary_key for primary_key, group_value in stored[key][len(incoming[key]):]]
+            inserted_rows += [get_values(row) for row in incoming[key][len(stored[key]):]]
+
+        for primary_keys in chunks(deleted_primary_keys):
+            db.session.execute(table.delete().where(primary_key_column.in_(primary_keys)))
+        update = table.update().where(primary_key_column == bindparam('_primary_key')).values({column: bindparam(column) for column in columns})
+        for batch in chunks(update_params):
+            db.session.execute(update, batch)
+        for batch in chunks(inserted_rows):
+            db.session.execute(table.insert(), batch)
+
+    for keys in chunks(deleted + updated):
+        db.session.query(RowHash).filter(RowHash.table_name == table.name).filter(RowHash.natural_key.in_(keys)).delete(synchronize_session=False)
+    for keys in chunks(inserted + updated):
+        db.session.execute(RowHash.__table__.insert(),
+                           [{"table_name": table.name, "natural_key": key, "content_hash": incoming_hashes[key]} for key in keys])
+
+    group_values.discard(None)
+    return TableDelta(table.name, inserted, updated, deleted, group_values)
+
+
+def get_affected_group_ids(deltas):
+    group_ids = set()
+    for delta in deltas:
+        if GROUP_COLUMNS[delta.table_name] == "group_id":
+            group_ids.update(delta.group_values)
+        elif delta.table_name == "eviction":
+            for names in chunks(delta.group_values):
+                group_ids.update(group_id for group_id, in db.session.query(Alias.group_id).filter(Alias.name.in_(names)))
+        elif delta.table_name == "codecase":
+            for parcel_ids in chunks(delta.group_values):
+                group_ids.update(group_id for group_id, in db.session.query(Property.group_id).filter(Property.parcel_id.in_(parcel_ids)))
+
+    group_ids.discard(None)
+    return group_ids
+
+
+# Applies `records`, an iterable of (model, row dict) pairs holding the complete new contents of
+# each model's table, as inserts, updates and deletes, and commits. Returns whether anything
+# changed, and the set of owner group IDs whose rows changed.
+def apply_deltas(models, records):
+    DataGeneration.__table__.create(bind=db.engine, checkfirst=True)
+    RowHash.__table__.create(bind=db.engine, checkfirst=True)
+
+    rows = {model: [] for model in models}
+    for model, row in records:
+        rows[model].append(row)
+
+    deltas = [apply_table_delta(model.__table__, rows[model]) for model in models]
+    for delta in deltas:
+        logging.warning(f"{delta.table_name}: {len(delta.inserted)} inserted, {len(delta.updated)} updated, {len(delta.deleted)} deleted.")
+
+    # Nothing to write means nothing to refresh, so the data generation stays as it is
+    if not any(delta.inserted or delta.updated or delta.deleted for delta in deltas):
+        db.session.commit()
+        return False, set()
+
+    group_ids = get_affected_group_ids(deltas)
+    generation = utils.bump_data_generation(', '.join(model.__tablename__ for model in models))
+    db.session.commit()
+
+    logging.warning(f"{len(group_ids)} owner groups affected. Data generation is now {generation.id}.")
+
+    return True, group_ids
@@ -0,0 +1,197 @@
+import csv
+import gzip
+import io
+import os
+import tempfile
+import threading
+import zlib
+from flask import request, Response, send_file, stream_with_context
+from sqlalchemy import Float, Integer, String
+from models import db, Landlord, LandlordScorecard
+import constants
+import serialization
+import utils
+
+
+##########################################
+# Dataset Export
+#
+# Streams every landlord with its counts and grades from landlord_scorecard
+# as CSV, NDJSON or Parquet. Rows are read with yield_per, so memory use
+# doesn't grow with the number of landlords. CSV and NDJSON are gzipped as
+# they're generated; the first request for each data generation streams
+# the export while saving it under EXPORT_CACHE_DIR, and later requests are
+# served from that file. Parquet needs pyarrow, which is optional.
+##########################################
+
+
+EXPORT_CACHE_DIR = os.environ.get("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "open-landlord-exports"))
+
+EXPORT_COLUMNS = [
+    Landlord.group_id,
+    Landlord.name,
+    Landlord.address,
+    LandlordScorecard.property_count,
+    LandlordScorecard.unit_count,
+    LandlordScorecard.evictions_count,
+    LandlordScorecard.code_violations_count,
+    LandlordScorecard.evictions_per_unit,
+    LandlordScorecard.code_violations_per_unit,
+    LandlordScorecard.evictions_grade,
+    LandlordScorecard.code_violations_grade,
+    LandlordScorecard.score,
+    LandlordScorecard.grade,
+]
+
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def get_column_names():
+    return [column.name for column in EXPORT_COLUMNS]
+
+
+def iter_export_batches():
+    rows = db.session.query(*EXPORT_COLUMNS)\
+        .outerjoin(LandlordScorecard, LandlordScorecard.group_id == Landlord.group_id)\
+        .order_by(Landlord.id)\
+        .yield_per(constants.EXPORT_BATCH_SIZE)
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= constants.EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_csv_chunks():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(get_column_names())
+    for batch in iter_export_batches():
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson_chunks():
+    names = get_column_names()
+    for batch in iter_export_batches():
+        yield ''.join(serialization.encode_json(dict(zip(names, row))) + '\n' for row in batch)
+
+
+def write_parquet(filename):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportUnavailable("Parquet exports need the pyarrow package, which isn't installed.")
+
+    # The schema comes from the column types, since a batch can be entirely NULL in a column (e.g. unit_count)
+    parquet_types = {Integer: pyarrow.int64(), Float: pyarrow.float64(), String: pyarrow.string()}
+    schema = pyarrow.schema([(column.name, parquet_types[type(column.type)]) for column in EXPORT_COLUMNS])
+
+    names = get_column_names()
+    with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+        for batch in iter_export_batches():
+            writer.write_table(pyarrow.Table.from_pylist([dict(zip(names, row)) for row in batch], schema=schema))
+
+
+def get_cache_extension(export_format):
+    return export_format if export_format == "parquet" else f"{export_format}.gz"
+
+
+def get_cache_filename(generation, export_format):
+    return os.path.join(EXPORT_CACHE_DIR, f"landlords-{generation}.{get_cache_extension(export_format)}")
+
+
+def remove_stale_exports(export_format, current_filename):
+    for filename in os.listdir(EXPORT_CACHE_DIR):
+        path = os.path.join(EXPORT_CACHE_DIR, filename)
+        if path != current_filename and filename.startswith("landlords-") and filename.endswith(f".{get_cache_extension(export_format)}"):
+            os.remove(path)
+
+
+def get_temporary_filename(filename):
+    return f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def iter_gzip_export(chunks, filename, send_compressed):
+    # Compresses the export as it's generated, saving it for later requests and sending it on.
+    # If the client goes away halfway through, the partial file is thrown away.
+    temporary_filename = get_temporary_filename(filename)
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    is_complete = False
+    try:
+        with open(temporary_filename, 'wb') as f:
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                compressed = compressor.compress(data)
+                f.write(compressed)
+                yield compressed if send_compressed else data
+            compressed = compressor.flush()
+            f.write(compressed)
+            if send_compressed:
+                yield compressed
+        os.replace(temporary_filename, filename)
+        is_complete = True
+    finally:
+        if not is_complete and os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+
+
+def iter_decompressed_file(filename):
+    with gzip.open(filename, 'rb') as f:
+        while True:
+            data = f.read(constants.EXPORT_READ_CHUNK_BYTES)
+            if not data:
+                break
+            yield data
+
+
+def get_export_response(export_format):
+    generation = utils.get_data_generation()
+    filename = get_cache_filename(generation, export_format)
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+
+    if export_format == "parquet":
+        if not os.path.exists(filename):
+            temporary_filename = get_temporary_filename(filename)
+            try:
+                write_parquet(temporary_filename)
+                os.replace(temporary_filename, filename)
+            finally:
+                if os.path.exists(temporary_filename):
+                    os.remove(temporary_filename)
+            remove_stale_exports(export_format, filename)
+        return send_file(filename, mimetype=EXPORT_MIMETYPES[export_format], as_attachment=True,
+                         attachment_filename="landlords.parquet", conditional=True)
+
+    send_compressed = "gzip" in request.accept_encodings
+    if os.path.exists(filename):
+        if send_compressed:
+            response = send_file(filename, mimetype=EXPORT_MIMETYPES[export_format], conditional=True)
+        else:
+            response = Response(iter_decompressed_file(filename), mimetype=EXPORT_MIMETYPES[export_format])
+    else:
+        remove_stale_exports(export_format, filename)
+        chunks = iter_csv_chunks() if export_format == "csv" else iter_ndjson_chunks()
+        response = Response(stream_with_context(iter_gzip_export(chunks, filename, send_compressed)), mimetype=EXPORT_MIMETYPES[export_format])
+
+    if send_compressed:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Content-Disposition"] = f"attachment; filename=landlords.{export_format}"
+    return response
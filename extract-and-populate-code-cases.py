@@ -1,15 +1,23 @@
+import argparse
 import requests
 import json
 import time
 import logging
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from models import db, CodeCase
+from models import CodeCase
 from app import app
+import refresh
+import bulk_load
+import delta_load
 
 REQUEST_BODY_FILE = './rop-request-formatted.json'
-CODE_SEARCH_URL = 'https://albanyny-energovpub.tylerhost.net/apps/selfservice/api/energov/search/search'
-CUSTOM_FIELDS_URL = 'https://albanyny-energovpub.tylerhost.net/apps/selfservice/api/energov/customfields/data/'
+ENERGOV_API_URL = 'https://albanyny-energovpub.tylerhost.net/apps/selfservice/api/energov'
+CODE_SEARCH_PATH = '/search/search'
+CUSTOM_FIELDS_PATH = '/customfields/data/'
 HISTORICAL_START_YEAR = 1900
 HISTORICAL_END_YEAR = 2014
 
@@ -20,57 +28,285 @@ HEADERS = {
 	"tenantName": "AlbanyNY",
 }
 
-def get_custom_fields(rop_entity_id):
-	request_body = CUSTOM_FIELDS_REQUEST_TEMPLATE
-	request_body["EntityId"] = rop_entity_id
-	r = requests.post(CUSTOM_FIELDS_URL, json=request_body, headers=HEADERS)
-	
-	while "Success" not in r.json():
-		logging.error(r.json())
-		logging.error(rop_entity_id)
-		logging.error("Request failed. Waiting and trying again.")
-		time.sleep(30)
-		r = requests.post(CUSTOM_FIELDS_URL, json=request_body, headers=HEADERS)
-
-	results = r.json()
-	time.sleep(2)
-	return results["Result"]["CustomGroups"][0]["CustomFields"]
-
-def get_results_one_year(year):
-	return get_results_year_range(year, year)
-
-# CAUTION: If we have too many results here, the API will fail. We can handle pulling up until 2014.
-def get_results_year_range(from_year, to_year):
-	return get_code_case_results(f"{from_year}-01-01T05:00:00.000Z", f"{to_year}-12-31T05:00:00.000Z")
-
-def get_code_case_results(from_datetime, to_datetime):
+# Requests are spread over a few threads, but all of them share one rate limit, which is what sets
+# the pace. Fetching one at a time with a 2 second pause came to under 0.5 requests a second.
+DEFAULT_WORKERS = 4
+DEFAULT_REQUESTS_PER_SECOND = 2
+RETRY_WAIT_SECONDS = 30
+MAX_RETRIES = 5
+
+# Search windows that fail this many times in a row are split rather than retried further, up to
+# MAX_FAILURE_SPLITS times per run. Past that the API is more likely down than overloaded, so the run stops.
+SEARCH_ATTEMPTS_BEFORE_SPLIT = 2
+MAX_FAILURE_SPLITS = 10
+SPLIT_UNITS = ["year", "quarter", "month", "day"]
+
+# Responses are saved here as they arrive, so an interrupted run picks up where it left off
+DEFAULT_CHECKPOINT_FILE = './code-case-checkpoint.sqlite'
+
+# Custom fields are kept here between runs. Cases closed within the last few days are always re-fetched.
+DEFAULT_CUSTOM_FIELDS_CACHE_FILE = './custom-fields-cache.sqlite'
+CUSTOM_FIELDS_SETTLED_DAYS = 30
+
+
+class RateLimiter:
+	# Token bucket shared by every worker thread
+	def __init__(self, requests_per_second, burst=1):
+		self.rate = requests_per_second
+		self.capacity = burst
+		self.tokens = burst
+		self.updated_at = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens = self.tokens - 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+# JSON responses keyed by namespace and key, in a local SQLite file shared by all worker threads
+class ResponseStore:
+	def __init__(self, filename):
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		self.lock = threading.Lock()
+		with self.lock:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS responses (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))")
+			self.connection.commit()
+
+	def get(self, namespace, key):
+		with self.lock:
+			row = self.connection.execute("SELECT value FROM responses WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+		return None if row is None else json.loads(row[0])
+
+	def put(self, namespace, key, value):
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO responses (namespace, key, value) VALUES (?, ?, ?)", (namespace, key, json.dumps(value)))
+			self.connection.commit()
+
+	def clear(self):
+		with self.lock:
+			self.connection.execute("DELETE FROM responses")
+			self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+
+class SplitBudget:
+	# Shared by every worker thread
+	def __init__(self, max_splits):
+		self.remaining = max_splits
+		self.lock = threading.Lock()
+
+	def take(self):
+		with self.lock:
+			if self.remaining <= 0:
+				return False
+			self.remaining = self.remaining - 1
+			return True
+
+
+class EnerGovClient:
+	def __init__(self, api_url, rate_limiter):
+		self.api_url = api_url
+		self.rate_limiter = rate_limiter
+		self.session = requests.Session()
+		self.session.headers.update(HEADERS)
+
+	def post(self, path, request_body, attempts=MAX_RETRIES):
+		for attempt in range(attempts):
+			self.rate_limiter.acquire()
+			try:
+				response = self.session.post(self.api_url + path, json=request_body).json()
+			except (requests.RequestException, ValueError) as e:
+				response = {"Success": False, "Error": str(e)}
+
+			if response.get("Success"):
+				return response["Result"]
+
+			logging.error(response)
+			if attempt + 1 < attempts:
+				logging.error(f"Request to {path} failed. Waiting and trying again.")
+				time.sleep(RETRY_WAIT_SECONDS)
+
+		raise RuntimeError(f"Request to {path} failed {attempts} times.")
+
+
+# Custom fields stop changing once a case is closed, so cached ones are reused unless the case has
+# changed since they were fetched or was closed too recently to be settled. Ones fetched earlier in
+# the same run (including before it was interrupted and resumed) are always reused.
+def is_cached_custom_fields_fresh(code_case, cached, run_id):
+	if cached is None or cached["case_status"] != code_case["CaseStatus"] or cached["final_date"] != code_case["FinalDate"]:
+		return False
+	if cached.get("run_id") == run_id:
+		return True
+	if code_case["FinalDate"] is None:
+		return False
+
+	final_datetime = datetime.strptime(code_case["FinalDate"][:19], '%Y-%m-%dT%H:%M:%S')
+	return final_datetime < datetime.now() - timedelta(days=CUSTOM_FIELDS_SETTLED_DAYS)
+
+# Returns the case's custom fields and whether they came from the cache
+def get_custom_fields(client, custom_fields_cache, run_id, code_case):
+	rop_entity_id = code_case["CaseId"]
+	cached = custom_fields_cache.get("custom_fields", rop_entity_id)
+	if is_cached_custom_fields_fresh(code_case, cached, run_id):
+		return cached["custom_fields"], True
+
+	request_body = dict(CUSTOM_FIELDS_REQUEST_TEMPLATE, EntityId=rop_entity_id)
+	custom_fields = client.post(CUSTOM_FIELDS_PATH, request_body)["CustomGroups"][0]["CustomFields"]
+	custom_fields_cache.put("custom_fields", rop_entity_id, {
+		"case_status": code_case["CaseStatus"],
+		"final_date": code_case["FinalDate"],
+		"run_id": run_id,
+		"custom_fields": custom_fields
+	})
+	return custom_fields, False
+
+# Identifies the run in progress. It's kept in the checkpoint, so a resumed run keeps its ID.
+def get_run_id(checkpoint):
+	run_id = checkpoint.get("run", "id")
+	if run_id is None:
+		run_id = datetime.now().isoformat()
+		checkpoint.put("run", "id", run_id)
+	return run_id
+
+# Windows are inclusive (first day, last day) date pairs, sent as midnight local time
+def format_window_date(day):
+	return f"{day.isoformat()}T05:00:00.000Z"
+
+def get_window_key(window):
+	return f"{format_window_date(window[0])}/{format_window_date(window[1])}"
+
+def get_next_boundary(day, unit):
+	if unit == "year":
+		return date(day.year + 1, 1, 1)
+	if unit == "quarter":
+		return date(day.year, day.month - (day.month - 1) % 3, 1) + relativedelta(months=3)
+	if unit == "month":
+		return date(day.year, day.month, 1) + relativedelta(months=1)
+	return day + timedelta(days=1)
+
+# Splits a window at the coarsest calendar unit that divides it: year, then quarter, month and day.
+# Returns None for a single day.
+def split_window(window):
+	first_day, last_day = window
+	for unit in SPLIT_UNITS:
+		pieces = []
+		piece_start = first_day
+		while piece_start <= last_day:
+			piece_end = min(get_next_boundary(piece_start, unit), last_day + timedelta(days=1))
+			pieces.append((piece_start, piece_end - timedelta(days=1)))
+			piece_start = piece_end
+		if len(pieces) > 1:
+			return pieces
+	return None
+
+def get_code_case_results(client, window, attempts):
 	with open(REQUEST_BODY_FILE) as f:
 		request_body = json.load(f) 
-		request_body["CodeCaseCriteria"]["OpenedDateFrom"] = from_datetime
-		request_body["CodeCaseCriteria"]["OpenedDateTo"] = to_datetime
-		# print(request_body)
+		request_body["CodeCaseCriteria"]["OpenedDateFrom"] = format_window_date(window[0])
+		request_body["CodeCaseCriteria"]["OpenedDateTo"] = format_window_date(window[1])
+
+	result = client.post(CODE_SEARCH_PATH, request_body, attempts)
+	results = result["EntityResults"]
+	is_truncated = len(results) >= request_body["CodeCaseCriteria"]["PageSize"] or result.get("TotalFound", 0) > len(results)
+	return results, is_truncated
+
+# Returns the window's code cases, or None if it has to be split into smaller windows first
+def get_window_results(client, checkpoint, failure_splits, window):
+	key = get_window_key(window)
+	if checkpoint.get("search_split", key):
+		return None
+
+	results = checkpoint.get("search", key)
+	if results is not None:
+		return results
 
-		r = requests.post(CODE_SEARCH_URL, json=request_body, headers=HEADERS)
-		if not r.json()["Success"]:
-			logging.error(r.json())
-			exit(0)
+	can_split = window[0] < window[1]
+	try:
+		results, is_truncated = get_code_case_results(client, window, SEARCH_ATTEMPTS_BEFORE_SPLIT if can_split else MAX_RETRIES)
+	except RuntimeError:
+		if not can_split or not failure_splits.take():
+			raise
+		is_truncated = True
 
-		codeCaseResults = r.json()["Result"]["EntityResults"]
-		return codeCaseResults
+	if is_truncated and can_split:
+		logging.warning(f"Window {key} is too large or failing. Splitting it.")
+		checkpoint.put("search_split", key, True)
+		return None
+	if is_truncated:
+		logging.error(f"Window {key} can't be split any further and may be missing code cases.")
 
-def build_full_code_case_results():
-	cumulativeResults = get_results_year_range(HISTORICAL_START_YEAR, HISTORICAL_END_YEAR)
+	checkpoint.put("search", key, results)
+	logging.warning(f"Fetched {key}. This window size is {len(results)}.")
+	return results
 
+# Everything up to 2014 fits in one window, and a year at a time after that. Windows that turn out
+# to be too large are split as they're fetched, into pieces that never overlap.
+def get_search_windows():
+	windows = [(date(HISTORICAL_START_YEAR, 1, 1), date(HISTORICAL_END_YEAR, 12, 31))]
 	for year in range(HISTORICAL_END_YEAR + 1, datetime.now().year + 1):
-		annualResults = get_results_one_year(year)
-		logging.error(f"Fetching year {year}. This year size is {len(annualResults)}, cumulative is {len(cumulativeResults)}")
-		cumulativeResults = cumulativeResults + annualResults
-		time.sleep(2)
+		windows.append((date(year, 1, 1), date(year, 12, 31)))
+	return windows
+
+def build_full_code_case_results(client, checkpoint, executor):
+	code_cases = {}
+	failure_splits = SplitBudget(MAX_FAILURE_SPLITS)
+	pending = {executor.submit(get_window_results, client, checkpoint, failure_splits, window): window for window in get_search_windows()}
+	while pending:
+		done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+		for future in done:
+			window = pending.pop(future)
+			try:
+				results = future.result()
+			except RuntimeError:
+				# Windows already fetched stay in the checkpoint for the next run
+				for other_future in pending:
+					other_future.cancel()
+				raise
+			if results is None:
+				for piece in split_window(window):
+					pending[executor.submit(get_window_results, client, checkpoint, failure_splits, piece)] = piece
+				continue
+			for code_case in results:
+				code_cases[code_case["CaseId"]] = code_case
+
+	return list(code_cases.values())
+
+
+def needs_custom_fields(code_case):
+	if code_case["FinalDate"] is None or code_case["CaseType"] != "ROP":
+		return False
+
+	final_datetime = datetime.strptime(code_case["FinalDate"][:19], '%Y-%m-%dT%H:%M:%S')
+	rop_validity = datetime.now() - relativedelta(years=2)
+	return final_datetime > rop_validity
+
+
+def fetch_all_custom_fields(client, custom_fields_cache, run_id, executor, json_results):
+	code_cases = [code_case for code_case in json_results if needs_custom_fields(code_case)]
+	logging.warning(f"Fetching custom fields for {len(code_cases)} ROP cases.")
+
+	custom_fields_by_case = {}
+	hits = 0
+	for code_case, (custom_fields, is_hit) in zip(code_cases, executor.map(lambda code_case: get_custom_fields(client, custom_fields_cache, run_id, code_case), code_cases)):
+		custom_fields_by_case[code_case["CaseId"]] = custom_fields
+		hits = hits + is_hit
 
-	return cumulativeResults
+	hit_rate = hits / len(code_cases) if code_cases else 0
+	logging.warning(f"Custom fields cache: {hits} hits, {len(code_cases) - hits} fetched ({hit_rate:.1%} hit rate).")
+	return custom_fields_by_case
 
 
-def handle_custom_fields(code_case):
+def handle_custom_fields(code_case, custom_fields_by_case):
 	custom_fields_to_return = {
 		"number_of_residential_units_in_building": None,
 		"number_of_units_to_receive_rops": None,
@@ -78,14 +314,8 @@ def handle_custom_fields(code_case):
 		"issue_rops": None
 	}
 
-	if code_case["FinalDate"] is None or code_case["CaseType"] != "ROP":
-		return custom_fields_to_return
-
-	final_datetime = datetime.strptime(code_case["FinalDate"][:19], '%Y-%m-%dT%H:%M:%S')
-	rop_validity = datetime.now() - relativedelta(years=2)
-
-	if final_datetime > rop_validity:
-		custom_fields_for_case = get_custom_fields(code_case["CaseId"])
+	if code_case["CaseId"] in custom_fields_by_case:
+		custom_fields_for_case = custom_fields_by_case[code_case["CaseId"]]
 
 		for field in custom_fields_for_case:
 			if field["FieldName"] == "NumberofResidentialUnitsinbuilding":
@@ -100,8 +330,18 @@ def handle_custom_fields(code_case):
 	return custom_fields_to_return
 
 
-def create_code_violations_table():
-	json_results = build_full_code_case_results()
+def create_code_violations_table(incremental=False, api_url=ENERGOV_API_URL, workers=DEFAULT_WORKERS,
+		requests_per_second=DEFAULT_REQUESTS_PER_SECOND, checkpoint_file=DEFAULT_CHECKPOINT_FILE,
+		custom_fields_cache_file=DEFAULT_CUSTOM_FIELDS_CACHE_FILE):
+	client = EnerGovClient(api_url, RateLimiter(requests_per_second))
+	checkpoint = ResponseStore(checkpoint_file)
+	custom_fields_cache = ResponseStore(custom_fields_cache_file)
+	run_id = get_run_id(checkpoint)
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		json_results = build_full_code_case_results(client, checkpoint, executor)
+		custom_fields_by_case = fetch_all_custom_fields(client, custom_fields_cache, run_id, executor, json_results)
+
 	code_case_objects = []
 	total = len(json_results)
 	count = 0
@@ -110,7 +350,7 @@ def create_code_violations_table():
 			logging.error(f"Processing code case {count} of {total}...")
 		count = count + 1
 
-		custom_fields = handle_custom_fields(code_case)
+		custom_fields = handle_custom_fields(code_case, custom_fields_by_case)
 		
 		address1 = "" if code_case["Address"] is None else code_case["Address"]["AddressLine1"]
 		address2 = "" if code_case["Address"] is None else code_case["Address"]["AddressLine2"]
@@ -133,18 +373,37 @@ def create_code_violations_table():
 			"issue_rops": custom_fields["issue_rops"]
 		}
 
-		code_case_objects.append(CodeCase(**code_case_json))
+		code_case_objects.append((CodeCase, code_case_json))
 
 	with app.app_context():
-		# First, delete existing Code Cases, then create, then commit
-		db.session.query(CodeCase).delete()
-		db.session.bulk_save_objects(code_case_objects)
-		db.session.commit()
+		if incremental:
+			# Only write Code Cases that changed, then rescore the affected owners
+			has_changes, group_ids = delta_load.apply_deltas([CodeCase], code_case_objects)
+			if has_changes:
+				refresh.refresh_derived_data(group_ids)
+			else:
+				logging.warning("Nothing changed since the last load.")
+		else:
+			# Replace existing Code Cases and commit
+			bulk_load.load_tables([CodeCase], code_case_objects)
+			refresh.refresh_derived_data()
+
+	# Everything is in the database now, so the next run should start fresh
+	checkpoint.clear()
+	checkpoint.close()
+	custom_fields_cache.close()
 
 def main():
-	create_code_violations_table()
-	#print(get_custom_fields('941dba5b-00e7-4fd2-bffd-b5bcef52a8bd'))
+	parser = argparse.ArgumentParser(description='Populate code cases from the EnerGov search API')
+	parser.add_argument('--incremental', action='store_true', help='Only write code cases that changed since the last load')
+	parser.add_argument('--api-url', type=str, default=ENERGOV_API_URL, help='EnerGov API base URL, e.g. a local stub for testing')
+	parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+	parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Shared rate limit across all workers. This, not --workers, sets how fast the fetch goes')
+	parser.add_argument('--checkpoint', type=str, default=DEFAULT_CHECKPOINT_FILE, help='File that saves progress so an interrupted run can resume')
+	parser.add_argument('--custom-fields-cache', type=str, default=DEFAULT_CUSTOM_FIELDS_CACHE_FILE, help='File that keeps custom fields between runs')
+	args = parser.parse_args()
+
+	create_code_violations_table(args.incremental, args.api_url, args.workers, args.requests_per_second, args.checkpoint, args.custom_fields_cache)
 
 if __name__ == "__main__":
 	main()
-
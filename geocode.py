@@ -1,8 +1,14 @@
-import requests
-from models import db, Landlord, Property
-from app import app
+import argparse
+import csv
+import logging
+import sqlite3
 import time
+import requests
 import urllib3
+from models import db, Property, DataGeneration, MapTile
+import utils
+import tiles
+import response_cache
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -14,26 +20,185 @@ REPLACEMENTS = [
 	("FOURTH", "4th"),
 ]
 
-def geocode():
-	with app.app_context():
-		properties = Property.query.filter(Property.latitude.is_(None)).order_by(Property.id.desc())
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+NOMINATIM_USER_AGENT = 'open-landlord-geocoder'
+GEOCODE_LOCALITY = 'Albany, NY'
+DEFAULT_REQUESTS_PER_SECOND = 1
+
+# Resolved addresses are kept here between runs, so re-running only looks up new addresses
+DEFAULT_CACHE_FILE = './geocode-cache.sqlite'
+DEFAULT_SEED_FILE = './data/albany_properties_lat_lon.csv'
+UPDATE_BATCH_SIZE = 500
+
+
+def normalize_address(address):
+	# Property addresses are just the street line; seed file addresses also have city, state and zip
+	address = ' '.join(address.split(',')[0].upper().split())
+
+	# Mapbox struggles with Fourth vs. 4th, etc.
+	for replacement in REPLACEMENTS:
+		address = address.replace(replacement[0], replacement[1])
+	return address
+
+
+def read_seed_locations(filename):
+	with open(filename, 'r') as csvfile:
+		reader = csv.DictReader(csvfile)
+		for row in reader:
+			if row["address"] and row["latitude"] and row["longitude"]:
+				yield (normalize_address(row["address"]), float(row["latitude"]), float(row["longitude"]))
+
+
+##########################################
+# Address Cache
+#
+# Normalized address -> (latitude, longitude). Addresses the provider
+# couldn't find are stored with no location, so they aren't looked up
+# again unless asked to.
+##########################################
+
+
+class GeocodeCache:
+	def __init__(self, filename):
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS geocode (address TEXT PRIMARY KEY, latitude REAL, longitude REAL)")
+		self.connection.commit()
+
+	def seed(self, filename):
+		self.connection.executemany("INSERT OR IGNORE INTO geocode (address, latitude, longitude) VALUES (?, ?, ?)", read_seed_locations(filename))
+		self.connection.commit()
+
+	def get_all(self):
+		return {address: (latitude, longitude) for address, latitude, longitude in self.connection.execute("SELECT address, latitude, longitude FROM geocode")}
+
+	def put(self, address, location):
+		latitude, longitude = location if location is not None else (None, None)
+		self.connection.execute("INSERT OR REPLACE INTO geocode (address, latitude, longitude) VALUES (?, ?, ?)", (address, latitude, longitude))
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+
+##########################################
+# Providers
+#
+# A provider has a geocode(address) method returning (latitude, longitude),
+# or None if it can't find the address.
+##########################################
+
+
+class NominatimProvider:
+	def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+		self.interval = 1 / requests_per_second
+		self.last_request_at = 0
+		self.session = requests.Session()
+		self.session.headers.update({"User-Agent": NOMINATIM_USER_AGENT})
 
-		for property in properties:
-			address = property.address
+	def geocode(self, address):
+		wait = self.last_request_at + self.interval - time.monotonic()
+		if wait > 0:
+			time.sleep(wait)
+		self.last_request_at = time.monotonic()
 
-			# Mapbox struggles with Fourth vs. 4th, etc.
-			for replacement in REPLACEMENTS:
-				address = address.replace(replacement[0], replacement[1])
+		response = self.session.get(NOMINATIM_URL, params={"q": f"{address}, {GEOCODE_LOCALITY}", "format": "json", "limit": 1}, verify=False)
+		response.raise_for_status()
+		results = response.json()
+		if not results:
+			return None
+		logging.warning(f"Latitude: {results[0]['lat']}, Longitude: {results[0]['lon']}, Address: {results[0]['display_name']}")
+		return (float(results[0]['lat']), float(results[0]['lon']))
 
-			url = 'https://nominatim.openstreetmap.org/search/' + address +'?format=json'
-			response = requests.get(url, verify=False).json()
-			if not response:
+
+class OfflineProvider:
+	# Looks addresses up in a CSV shaped like the seed file, without any network calls
+	def __init__(self, filename=DEFAULT_SEED_FILE):
+		self.locations = {address: (latitude, longitude) for address, latitude, longitude in read_seed_locations(filename)}
+
+	def geocode(self, address):
+		return self.locations.get(address)
+
+
+PROVIDERS = {
+	"nominatim": NominatimProvider,
+	"offline": OfflineProvider,
+}
+
+
+##########################################
+# Geocoding
+#
+##########################################
+
+
+def get_addresses_to_geocode():
+	# Normalized address -> IDs of the properties at that address that don't have a location yet
+	property_ids_by_address = {}
+	properties = db.session.query(Property.id, Property.address).filter(Property.latitude.is_(None)).filter(Property.address.isnot(None)).order_by(Property.id.desc())
+	for property_id, address in properties:
+		property_ids_by_address.setdefault(normalize_address(address), []).append(property_id)
+	return property_ids_by_address
+
+
+def flush_updates(updates):
+	for start in range(0, len(updates), UPDATE_BATCH_SIZE):
+		db.session.bulk_update_mappings(Property, updates[start:start + UPDATE_BATCH_SIZE])
+		db.session.commit()
+	return len(updates)
+
+
+def geocode(provider, cache_file=DEFAULT_CACHE_FILE, seed_file=DEFAULT_SEED_FILE, retry_misses=False):
+	# Imported here so importing this module doesn't set up the web app and its database connection
+	from app import app
+
+	cache = GeocodeCache(cache_file)
+	if seed_file:
+		cache.seed(seed_file)
+	cached_locations = cache.get_all()
+
+	with app.app_context():
+		property_ids_by_address = get_addresses_to_geocode()
+		logging.warning(f"{sum(len(ids) for ids in property_ids_by_address.values())} properties without a location at {len(property_ids_by_address)} addresses.")
+
+		updates = []
+		updated_count = 0
+		lookup_count = 0
+		for address, property_ids in property_ids_by_address.items():
+			if address in cached_locations and (cached_locations[address][0] is not None or not retry_misses):
+				location = cached_locations[address]
+			else:
+				location = provider.geocode(address)
+				cache.put(address, location)
+				lookup_count = lookup_count + 1
+
+			if location is None or location[0] is None:
 				continue
-			print('Latitude: '+response[0]['lat']+', Longitude: '+response[0]['lon'] +', Address: '+response[0]['display_name'])
-			property.latitude = response[0]['lat']
-			property.longitude= response[0]['lon']
+
+			updates.extend({"id": property_id, "latitude": location[0], "longitude": location[1]} for property_id in property_ids)
+			# Written in batches as we go, so an interrupted run keeps what it has resolved
+			if len(updates) >= UPDATE_BATCH_SIZE:
+				updated_count = updated_count + flush_updates(updates)
+				updates = []
+
+		updated_count = updated_count + flush_updates(updates)
+		if updated_count:
+			DataGeneration.__table__.create(bind=db.engine, checkfirst=True)
+			MapTile.__table__.create(bind=db.engine, checkfirst=True)
+			tiles.refresh_tiles()
+			utils.bump_data_generation("geocode")
 			db.session.commit()
-			time.sleep(.5)
+			response_cache.clear()
+
+	cache.close()
+	logging.warning(f"Looked up {lookup_count} addresses and located {updated_count} properties.")
+
 
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Fill in property locations')
+	parser.add_argument('--provider', choices=PROVIDERS.keys(), default="nominatim")
+	parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_FILE, help='File that keeps resolved addresses between runs')
+	parser.add_argument('--seed', type=str, default=DEFAULT_SEED_FILE, help='CSV of known locations to seed the cache with')
+	parser.add_argument('--retry-misses', action='store_true', help='Look up addresses the provider previously could not find')
+	args = parser.parse_args()
 
-geocode()
\ No newline at end of file
+	geocode(PROVIDERS[args.provider](), args.cache, args.seed, args.retry_misses)
@@ -0,0 +1,125 @@
+import argparse
+import json
+import logging
+import sys
+from sqlalchemy import func, inspect
+from models import db, Landlord, Property, Alias, Eviction, CodeCase, LandlordScorecard, MapTile
+from app import app
+import constants
+import utils
+
+
+##########################################
+# Index Management
+#
+# Indexes are declared on the models. create_all only adds them when it
+# creates a table, so ensure_indexes() adds any that are missing from
+# existing tables; refresh.py runs it after every load. `python indexes.py
+# --explain` also runs EXPLAIN on the queries behind the per-landlord
+# endpoints and reports any that still scan a whole table.
+##########################################
+
+
+INDEXED_MODELS = [Landlord, Property, Alias, Eviction, CodeCase, LandlordScorecard, MapTile]
+
+
+def ensure_indexes():
+    # Search uses pg_trgm indexes on Postgres; other databases fall back to plain scans
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        db.session.commit()
+
+    inspector = inspect(db.engine)
+    created = []
+    for model in INDEXED_MODELS:
+        existing = {index["name"] for index in inspector.get_indexes(model.__tablename__)}
+        for index in model.__table__.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    if created:
+        logging.warning(f"Created indexes: {', '.join(created)}.")
+    return created
+
+
+def get_sample_group_id():
+    # The owner group with the most properties is the most expensive case for every endpoint
+    return db.session.query(Property.group_id)\
+        .group_by(Property.group_id)\
+        .order_by(func.count(Property.id).desc())\
+        .limit(1)\
+        .scalar()
+
+
+def get_endpoint_queries(group_id, parcel_id, search_text):
+    queries = {
+        "/api/landlords/<group_id>": utils.landlord_query(group_id),
+        "/api/landlords/<group_id>/aliases": utils.landlord_aliases_query(group_id),
+        "/api/landlords/<group_id>/properties": utils.landlord_properties_query(group_id),
+        "/api/landlords/<group_id>/code_violations": utils.landlord_code_cases_query(group_id, [constants.CODE_VIOLATIONS_TYPE]),
+        "/api/landlords/<group_id>/evictions": utils.landlord_evictions_query(group_id),
+        "/api/landlords/<group_id>/unsafe_unfit": utils.landlord_unsafe_unfit_properties_query(group_id),
+        "/api/landlords/<group_id>/grades": utils.landlords_with_scorecards_query([group_id]),
+        "/api/properties/<id>": utils.property_unsafe_unfit_cases_query(parcel_id),
+    }
+
+    # Search relies on pg_trgm indexes, so other databases always scan for it
+    if db.engine.dialect.name == "postgresql":
+        queries["/api/search"] = utils.perform_search(search_text, constants.SEARCH_DEFAULT_MAX_RESULTS)
+    return queries
+
+
+def get_postgres_scanned_tables(plan):
+    tables = []
+    if plan.get("Node Type") == "Seq Scan":
+        tables.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        tables.extend(get_postgres_scanned_tables(child))
+    return tables
+
+
+# Returns the tables the query reads in full
+def get_scanned_tables(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True})
+    connection = db.session.connection()
+
+    if db.engine.dialect.name == "postgresql":
+        plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        return get_postgres_scanned_tables(plan[0]["Plan"])
+
+    # SQLite reports "SCAN <table>" for full table scans and "SEARCH <table> USING INDEX ..." otherwise
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    details = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", parameters)]
+    return [detail.split()[1] for detail in details if detail.startswith("SCAN ") and "INDEX" not in detail]
+
+
+def explain_endpoint_queries(group_id=None):
+    group_id = group_id if group_id is not None else get_sample_group_id()
+    parcel_id = db.session.query(Property.parcel_id).filter(Property.group_id == group_id).limit(1).scalar()
+    search_text = db.session.query(Alias.name).filter(Alias.group_id == group_id).limit(1).scalar()
+
+    scans = {}
+    for endpoint, query in get_endpoint_queries(group_id, parcel_id, search_text).items():
+        scanned_tables = get_scanned_tables(query)
+        if scanned_tables:
+            scans[endpoint] = scanned_tables
+        logging.warning(f"{endpoint}: {'full scan of ' + ', '.join(scanned_tables) if scanned_tables else 'index lookups only'}")
+    return scans
+
+
+##########################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create missing indexes and check that endpoint queries use them')
+    parser.add_argument('--explain', action='store_true', help='Report endpoint queries that scan whole tables; exits with 1 if any do')
+    parser.add_argument('--group-id', type=str, help='Owner group to explain the queries for (defaults to the largest)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        ensure_indexes()
+        if args.explain and explain_endpoint_queries(args.group_id):
+            sys.exit(1)
@@ -1,8 +1,9 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import case, inspect
+from sqlalchemy import case, inspect, text
 from sqlalchemy.sql import func, select
+from datetime import datetime
 
 
 db = SQLAlchemy()
@@ -10,6 +11,10 @@ db = SQLAlchemy()
 
 class Alias(db.Model):
     __tablename__ = "staging_alias"
+    __table_args__ = (
+        db.Index("ix_staging_alias_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        db.Index("ix_staging_alias_group_id_name", "group_id", "name"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
     group_id = db.Column(db.String(256), unique=False, nullable=True)
@@ -17,6 +22,9 @@ class Alias(db.Model):
 
 class Eviction(db.Model):
     __tablename__ = "eviction"
+    __table_args__ = (
+        db.Index("ix_eviction_matched_name_case_date", "matched_name", "case_date"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     caseid = db.Column(db.String(256), unique=True, nullable=True)
     case_date = db.Column(db.DateTime())
@@ -26,6 +34,12 @@ class Eviction(db.Model):
 
 class CodeCase(db.Model):
     __tablename__ = "codecase"
+    __table_args__ = (
+        # Only the case types the site reports on are looked up by parcel
+        db.Index("ix_codecase_parcel_id_case_type_apply_date", "parcel_id", "case_type", "apply_date",
+                 postgresql_where=text("case_type IN ('CODE ENFORCEMENT', 'UNSAFE & UNFIT', 'ROP')")),
+        db.Index("ix_codecase_case_type_apply_date", "case_type", "apply_date"),
+    )
     case_id = db.Column(db.String(80), primary_key=True)
     case_number = db.Column(db.String(256))
     case_type = db.Column(db.String(256))
@@ -45,6 +59,11 @@ class CodeCase(db.Model):
 
 class Landlord(db.Model):
     __tablename__ = "staging_landlord"
+    __table_args__ = (
+        db.Index("ix_staging_landlord_name_id", "name", "id"),
+        db.Index("ix_staging_landlord_address_id", "address", "id"),
+        db.Index("ix_staging_landlord_group_id", "group_id"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
     address = db.Column(db.String(250))
@@ -59,6 +78,11 @@ class Landlord(db.Model):
 
 class Property(db.Model):
     __tablename__ = "staging_property"
+    __table_args__ = (
+        db.Index("ix_staging_property_address_trgm", "address", postgresql_using="gin", postgresql_ops={"address": "gin_trgm_ops"}),
+        db.Index("ix_staging_property_group_id_parcel_id", "group_id", "parcel_id"),
+        db.Index("ix_staging_property_parcel_id_group_id", "parcel_id", "group_id"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     parcel_id = db.Column(db.String(250), nullable=False)
     address = db.Column(db.String(250), nullable=False)
@@ -83,3 +107,90 @@ class Property(db.Model):
     def as_dict(self):
        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
+
+
+class CityStats(db.Model):
+    __tablename__ = "city_stats"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    mean_evictions_per_unit = db.Column(db.Float)
+    mean_code_violations_per_unit = db.Column(db.Float)
+    std_dev_evictions = db.Column(db.Float)
+    std_dev_code_violations = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<CityStats %r>' % self.version
+
+    def as_dict(self):
+        return {
+            "mean_evictions_per_unit": self.mean_evictions_per_unit,
+            "mean_code_violations_per_unit": self.mean_code_violations_per_unit,
+            "std_dev_evictions": self.std_dev_evictions,
+            "std_dev_code_violations": self.std_dev_code_violations,
+        }
+
+
+class LandlordScorecard(db.Model):
+    __tablename__ = "landlord_scorecard"
+    __table_args__ = (
+        db.Index("ix_landlord_scorecard_score", "score", "group_id"),
+        db.Index("ix_landlord_scorecard_property_count", "property_count", "group_id"),
+        db.Index("ix_landlord_scorecard_unit_count", "unit_count", "group_id"),
+        db.Index("ix_landlord_scorecard_evictions_count", "evictions_count", "group_id"),
+        db.Index("ix_landlord_scorecard_code_violations_count", "code_violations_count", "group_id"),
+        db.Index("ix_landlord_scorecard_evictions_per_unit", "evictions_per_unit", "group_id"),
+        db.Index("ix_landlord_scorecard_code_violations_per_unit", "code_violations_per_unit", "group_id"),
+    )
+    group_id = db.Column(db.String(256), primary_key=True)
+    city_stats_version = db.Column(db.Integer, db.ForeignKey("city_stats.version"))
+    updated_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    property_count = db.Column(db.Integer)
+    unit_count = db.Column(db.Integer)
+    evictions_count = db.Column(db.Integer)
+    code_violations_count = db.Column(db.Integer)
+    evictions_per_unit = db.Column(db.Float)
+    code_violations_per_unit = db.Column(db.Float)
+    evictions_grade = db.Column(db.String(2))
+    evictions_color = db.Column(db.String(6))
+    evictions_grade_value = db.Column(db.Integer)
+    code_violations_grade = db.Column(db.String(2))
+    code_violations_color = db.Column(db.String(6))
+    code_violations_grade_value = db.Column(db.Integer)
+    score = db.Column(db.Float, nullable=False)
+    grade = db.Column(db.String(2))
+    color = db.Column(db.String(6))
+
+    def __repr__(self):
+        return '<LandlordScorecard %r>' % self.group_id
+
+    def as_dict(self):
+       return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class DataGeneration(db.Model):
+    __tablename__ = "data_generation"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow, nullable=False)
+    source = db.Column(db.String(256))
+
+    def __repr__(self):
+        return '<DataGeneration %r>' % self.id
+
+
+class RowHash(db.Model):
+    __tablename__ = "row_hash"
+    table_name = db.Column(db.String(80), primary_key=True)
+    natural_key = db.Column(db.String(256), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+
+
+class MapTile(db.Model):
+    __tablename__ = "map_tile"
+    z = db.Column(db.Integer, primary_key=True)
+    x = db.Column(db.Integer, primary_key=True)
+    y = db.Column(db.Integer, primary_key=True)
+    etag = db.Column(db.String(64), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return '<MapTile %r/%r/%r>' % (self.z, self.x, self.y)
@@ -4,10 +4,15 @@ import argparse
 import uuid
 import json
 import logging
-import usaddress
+import functools
+import itertools
 from hashlib import sha256
 from models import db, Landlord, Property, Alias, CodeCase
 from app import app
+import refresh
+import bulk_load
+import delta_load
+import utils
 from sqlalchemy import types, func
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -40,21 +45,29 @@ def get_clean_value(row, column_obj):
 
 
 def clean_name(name):
-    return ''.join(name.split()).lower()
+    return utils.clean_name(name)
 
 
-def get_group_id(name, groupings):
-    # Add group ID
-    group_id = None
+def build_group_index(groupings):
+    # Later rows win, matching the order groupings were previously scanned in
+    group_index = {}
     for group in groupings:
-        if clean_name(name) == clean_name(group["name"]):
-            group_id = group["group_id"]
+        group_index[clean_name(group["name"])] = group["group_id"]
+    return group_index
+
+
+@functools.lru_cache(maxsize=None)
+def get_hashed_group_id(cleaned_name):
+    return sha256(cleaned_name.encode('utf-8')).hexdigest()
 
-    # Generate our own hash based on owner name if none exists. We may want to use Name + Address to avoid overly matching
-    if group_id is None:
-        return sha256(clean_name(name).encode('utf-8')).hexdigest()
 
-    return group_id
+def get_group_id(name, group_index):
+    cleaned_name = clean_name(name)
+    if cleaned_name in group_index:
+        return group_index[cleaned_name]
+
+    # Generate our own hash based on owner name if none exists. We may want to use Name + Address to avoid overly matching
+    return get_hashed_group_id(cleaned_name)
 
 
 def update_landlord_obj(prop, landlord):
@@ -78,6 +91,12 @@ def parse_csv_as_dict_list(csv_filename):
         reader = csv.DictReader(csvfile)
         return list(reader)
 
+def iterate_csv_rows(csv_filename):
+    with open(csv_filename, 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            yield row
+
 def parse_geocoded_csv_as_map(csv_filename):
     geocoded_parcel_ids = {}
     with open(csv_filename, 'r') as csvfile:
@@ -92,32 +111,18 @@ def parse_geocoded_csv_as_map(csv_filename):
 #
 ##########################################
 
-def create_alias_list(properties, groupings):
-    logging.warning("Creating Alias List.")
-    aliases = []
-    seen_aliases = set()
-    for prop in properties:
-        alias_name = prop["Owner_1"]
-        if alias_name in seen_aliases:
-            continue
-            
-        group_id = get_group_id(prop["Owner_1"], groupings)
-
-        alias = {
-            "name": alias_name,
-            "group_id": group_id
-        }
-        aliases.append(alias)
-        seen_aliases.add(alias_name)
-
-    return aliases
+def create_alias(prop, group_index):
+    return {
+        "name": prop["Owner_1"],
+        "group_id": get_group_id(prop["Owner_1"], group_index)
+    }
 
 
 def get_street_name_and_number(raw_address):
     street_name = None
     house_number = None
     address_dict = {}
-    parsed_address_tuple_list = usaddress.parse(raw_address)
+    parsed_address_tuple_list = utils.parse_address(raw_address)
     for value, field in parsed_address_tuple_list:
         address_dict[field] = value
 
@@ -129,111 +134,93 @@ def get_street_name_and_number(raw_address):
     return (street_name, house_number)
 
 
-def create_property_list(properties, groupings, geocoding_map):
-    logging.warning("Creating Property List.")
-    property_objects = []
-    count = 0
-
-    for prop in properties:
-        if prop["Parcel ID"] is "" or prop["Owner_1"] is "":
-            continue
-
-        if count % 5000 == 0:
-            logging.warning(f"Property list, iterated over row {count}.")
-
-        property_dict = {}
-        for column_obj in COLUMN_LIST:
-            if not column_obj["is_owner_col"]:
-                property_dict[column_obj["db_column"]] = get_clean_value(prop, column_obj)
+def create_property(prop, group_id, geocoding_map):
+    property_dict = {}
+    for column_obj in COLUMN_LIST:
+        if not column_obj["is_owner_col"]:
+            property_dict[column_obj["db_column"]] = get_clean_value(prop, column_obj)
 
-        street_name, house_number = get_street_name_and_number(property_dict["address"])
-        property_dict["street_name"] = street_name
-        property_dict["house_number"] = house_number
+    street_name, house_number = get_street_name_and_number(property_dict["address"])
+    property_dict["street_name"] = street_name
+    property_dict["house_number"] = house_number
 
-        if prop["Parcel ID"] in geocoding_map:
-            property_dict["latitude"] = geocoding_map[prop["Parcel ID"]][0]
-            property_dict["longitude"] = geocoding_map[prop["Parcel ID"]][1]
+    if prop["Parcel ID"] in geocoding_map:
+        property_dict["latitude"] = geocoding_map[prop["Parcel ID"]][0]
+        property_dict["longitude"] = geocoding_map[prop["Parcel ID"]][1]
 
-        property_dict["group_id"] = get_group_id(prop["Owner_1"], groupings)
+    property_dict["group_id"] = group_id
+    return property_dict
 
 
-        property_objects.append(property_dict)
-        count = count + 1
+def add_to_landlords(prop, group_id, landlords):
+    if group_id in landlords:
+        update_landlord_obj(prop, landlords[group_id])
+    else:
+        landlord = create_landlord_obj(prop)
+        landlord["group_id"] = group_id
+        landlords[group_id] = landlord
 
 
-    return property_objects
-
-def create_landlord_list(properties, groupings):
-    logging.warning("Creating Landlord List.")
-    landlords = {}
-    logging.warning("Iterating over all properties.")
+def create_records(properties, group_index, geocoding_map, landlords):
+    # Single pass over the properties CSV: yields (model, row) pairs for aliases and
+    # properties as they are read, and fills in `landlords` keyed by group ID as it goes.
+    seen_aliases = set()
     count = 0
     for prop in properties:
-        if prop["Parcel ID"] is "" or prop["Owner_1"] is "":
+        if prop["Owner_1"] not in seen_aliases:
+            seen_aliases.add(prop["Owner_1"])
+            yield (Alias, create_alias(prop, group_index))
+
+        if prop["Parcel ID"] == "" or prop["Owner_1"] == "":
             continue
 
         if count % 5000 == 0:
-            logging.warning(f"Landlord list, iterated over row {count}.")
-
-        group_id = get_group_id(prop["Owner_1"], groupings)
-
-        if group_id in landlords:
-            update_landlord_obj(prop, landlords[group_id])
-        else:
-            landlord = create_landlord_obj(prop)
-            landlord["group_id"] = group_id
-            landlords[group_id] = landlord
+            logging.warning(f"Iterated over property row {count}.")
 
-        if landlord["name"] is None:
-            print(prop)
-            print(landlord)
+        group_id = get_group_id(prop["Owner_1"], group_index)
+        add_to_landlords(prop, group_id, landlords)
+        yield (Property, create_property(prop, group_id, geocoding_map))
 
         count = count + 1
 
-    return landlords
 
-def commit_to_db(landlord_list, property_list, alias_list):
-    landlords = []
-    properties = []
-    aliases = []
+def create_landlord_records(landlords):
+    for landlord in landlords.values():
+        yield (Landlord, landlord)
 
-    with app.app_context():
-        for group_id, landlord in landlord_list.items():
-            landlords.append(Landlord(**landlord))
-        for prop in property_list:
-            properties.append(Property(**prop))
-        for alias in alias_list:
-            aliases.append(Alias(**alias))
-
-        logging.warning("Deleting all data from tables.")
 
-        # Delete all rows from all tables
-        db.session.query(Landlord).delete()
-        db.session.query(Property).delete()
-        db.session.query(Alias).delete()
+def commit_to_db(records, landlords, incremental=False):
+    # Landlords are only complete once every property row has been read, so they are loaded last
+    records = itertools.chain(records, create_landlord_records(landlords))
 
-        logging.warning("Saving all objects now.")
+    with app.app_context():
+        if incremental:
+            logging.warning("Applying changes to tables.")
+            has_changes, group_ids = delta_load.apply_deltas([Landlord, Property, Alias], records)
+            if has_changes:
+                refresh.refresh_derived_data(group_ids)
+            else:
+                logging.warning("Nothing changed since the last load.")
+        else:
+            logging.warning("Replacing all data in tables.")
+            bulk_load.load_tables([Landlord, Property, Alias], records)
+            refresh.refresh_derived_data()
 
-        db.session.bulk_save_objects(landlords)
-        db.session.bulk_save_objects(properties)
-        db.session.bulk_save_objects(aliases)
 
-        logging.warning("Committing to database.")
+# TODO: Still requires deleting bogus lines at beginning of CSV and removing errant "=" signs from CSV
+def populate_database(properties_filename, groupings_filename, geo_filename, incremental=False):
+    logging.warning("Parsing groupings and geocoding CSVs.")
 
-        db.session.commit()
+    group_index = build_group_index(parse_csv_as_dict_list(groupings_filename)) # "/Users/akaier/Downloads/albany_owner_groups_with_properties_2023_03_23.csv")
+    geocoding_map = parse_geocoded_csv_as_map(geo_filename) #"/Users/akaier/Downloads/albany_properties_lat_lon.csv")
 
+    logging.warning("Streaming properties CSV into the database.")
 
-# TODO: Still requires deleting bogus lines at beginning of CSV and removing errant "=" signs from CSV
-def populate_database(properties_filename, groupings_filename, geo_filename):
-    logging.warning("Parsing CSVs as Dictionaries.")
+    properties = iterate_csv_rows(properties_filename) # "/Users/akaier/Downloads/tolemi-export1680275139690.csv")
+    landlords = {}
+    commit_to_db(create_records(properties, group_index, geocoding_map, landlords), landlords, incremental)
 
-    properties = parse_csv_as_dict_list(properties_filename) # "/Users/akaier/Downloads/tolemi-export1680275139690.csv")
-    groupings = parse_csv_as_dict_list(groupings_filename) # "/Users/akaier/Downloads/albany_owner_groups_with_properties_2023_03_23.csv")
-    geocoding_map = parse_geocoded_csv_as_map(geo_filename) #"/Users/akaier/Downloads/albany_properties_lat_lon.csv")
-    
-    landlord_list = create_landlord_list(properties, groupings)
-    property_list = create_property_list(properties, groupings, geocoding_map)
-    alias_list = create_alias_list(properties, groupings)
+    logging.warning(f"Address parse cache: {utils.get_address_cache_info()['parse_address']}")
 
 
 
@@ -246,10 +233,11 @@ if __name__ == '__main__':
     parser.add_argument('--properties', type=str)
     parser.add_argument('--groupings', type=str)
     parser.add_argument('--geocoding', type=str)
+    parser.add_argument('--incremental', action='store_true', help='Only write rows that changed since the last load')
 
     args = parser.parse_args()
 
-    populate_database(args.properties, args.groupings, args.geocoding)
+    populate_database(args.properties, args.groupings, args.geocoding, args.incremental)
 
 
 
@@ -1,10 +1,14 @@
+import argparse
 import csv
-from models import db, Eviction
+import logging
+from models import Eviction
 from app import app
+import refresh
+import bulk_load
+import delta_load
 
 
-def create_evictions_table(filename):
-	eviction_objects = []
+def read_eviction_records(filename):
 	seen_cases = set()
 	with open(filename, 'r') as file:
 		csv_reader = csv.DictReader(file)
@@ -26,17 +30,29 @@ def create_evictions_table(filename):
 				"matched_name": eviction["MatchedName"],
 			}
 
-			
-			eviction_objects.append(Eviction(**eviction_json))
+			yield (Eviction, eviction_json)
 
+
+def create_evictions_table(filename, incremental=False):
 	with app.app_context():
-		db.session.query(Eviction).delete()
-		db.session.bulk_save_objects(eviction_objects)
-		db.session.commit()
+		if incremental:
+			has_changes, group_ids = delta_load.apply_deltas([Eviction], read_eviction_records(filename))
+			if has_changes:
+				refresh.refresh_derived_data(group_ids)
+			else:
+				logging.warning("Nothing changed since the last load.")
+		else:
+			bulk_load.load_tables([Eviction], read_eviction_records(filename))
+			refresh.refresh_derived_data()
 
 
 def main():
-	create_evictions_table("/Users/akaier/Downloads/Albany Evictions Logger - Export Log.csv")
+	parser = argparse.ArgumentParser(description='Populate evictions from the Albany Evictions Logger export')
+	parser.add_argument('--filename', type=str, default="/Users/akaier/Downloads/Albany Evictions Logger - Export Log.csv")
+	parser.add_argument('--incremental', action='store_true', help='Only write evictions that changed since the last load')
+	args = parser.parse_args()
+
+	create_evictions_table(args.filename, args.incremental)
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,70 @@
+import argparse
+import logging
+from models import db
+from app import app
+import utils
+import tiles
+import indexes
+import response_cache
+
+
+##########################################
+# Derived Data Refresh
+#
+# Recomputes everything that is derived from the raw landlord, property,
+# alias, eviction and code case tables. The populate scripts call
+# refresh_derived_data() after committing new data; it can also be run
+# by hand with `python refresh.py`. The city stats cover a rolling window,
+# so a scheduler should also run `python refresh.py --if-stale`, which only
+# refreshes once the latest snapshot is older than CITY_STATS_MAX_AGE_SECONDS.
+##########################################
+
+
+def ensure_tables_and_indexes():
+    db.create_all()
+    indexes.ensure_indexes()
+
+
+def refresh_derived_data(group_ids=None):
+    # Make sure any derived tables and search indexes exist before writing to them
+    ensure_tables_and_indexes()
+
+    logging.warning("Refreshing city stats snapshot.")
+    snapshot = utils.refresh_city_stats()
+    logging.warning(f"City stats snapshot version {snapshot.version} saved.")
+
+    # City stats are city-wide and always recomputed. After an incremental load only the
+    # owner groups in `group_ids` are recounted, but every scorecard is regraded
+    logging.warning("Refreshing landlord scorecards.")
+    scorecard_count = utils.refresh_landlord_scorecards(snapshot, group_ids)
+    logging.warning(f"Saved {scorecard_count} landlord scorecards.")
+
+    # Tiles carry grade colors, so they're rebuilt after the scorecards
+    logging.warning("Refreshing map tiles.")
+    tile_count = tiles.refresh_tiles()
+    logging.warning(f"Saved {tile_count} map tiles.")
+
+    # Let every worker know the derived data changed
+    generation = utils.bump_data_generation("refresh")
+    db.session.commit()
+
+    # Workers drop their own cached responses when they see the new generation; the shared cache is cleared here
+    response_cache.clear()
+    logging.warning(f"Data generation is now {generation.id}.")
+
+
+##########################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute derived stats after a data refresh')
+    parser.add_argument('--if-stale', action='store_true', help='Only refresh if the latest city stats snapshot is older than CITY_STATS_MAX_AGE_SECONDS')
+    args = parser.parse_args()
+
+    with app.app_context():
+        # Tables added since the last deploy are created even when nothing needs refreshing
+        ensure_tables_and_indexes()
+        if args.if_stale and not utils.is_city_stats_snapshot_stale(utils.get_latest_city_stats_snapshot()):
+            logging.warning("City stats snapshot is up to date.")
+        else:
+            refresh_derived_data()
@@ -0,0 +1,211 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from flask import request, make_response, Response
+import constants
+import utils
+
+
+##########################################
+# Response Cache
+#
+# Read-only API responses only change when the data does, so they're cached
+# by route, query arguments and data generation. Each worker keeps an LRU of
+# recent responses; setting RESPONSE_CACHE_URL to "file:///some/directory"
+# or "redis://..." adds a cache shared by every worker on top of it. Cached
+# responses carry an ETag, so clients and CDNs can revalidate with 304s.
+#
+# Bumping the data generation makes every older entry unreachable, and the
+# derived data refresh that ends each populate script also clears the
+# shared cache.
+##########################################
+
+
+class LRUCache:
+    # Bounded by the total size of the values, since one response can be a few bytes or several megabytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes = self.total_bytes - self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes = self.total_bytes + size
+            while self.total_bytes > self.max_bytes:
+                evicted_value, evicted_size = self.entries.popitem(last=False)[1]
+                self.total_bytes = self.total_bytes - evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+class DiskCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.get_filename(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        # Written to a temporary file and renamed, so other workers never read half an entry
+        filename = self.get_filename(key)
+        temporary_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+        with open(temporary_filename, 'w') as f:
+            json.dump(value, f)
+        os.replace(temporary_filename, filename)
+
+    def clear(self):
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(self.directory, filename))
+
+
+class RedisCache:
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_URL points at Redis, but the redis package isn't installed.")
+        self.client = redis.Redis.from_url(url)
+
+    def get_key(self, key):
+        return "response:" + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = self.client.get(self.get_key(key))
+        return json.loads(value) if value is not None else None
+
+    def put(self, key, value):
+        self.client.set(self.get_key(key), json.dumps(value), ex=constants.RESPONSE_CACHE_SHARED_TTL_SECONDS)
+
+    def clear(self):
+        for key in self.client.scan_iter("response:*"):
+            self.client.delete(key)
+
+
+def create_shared_cache(url):
+    if not url:
+        return None
+    if url.startswith("file://"):
+        return DiskCache(url[len("file://"):])
+    if url.startswith("redis://") or url.startswith("rediss://") or url.startswith("unix://"):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported RESPONSE_CACHE_URL: {url}")
+
+
+_local_cache = LRUCache(constants.RESPONSE_CACHE_MAX_BYTES)
+_shared_cache = create_shared_cache(os.environ.get("RESPONSE_CACHE_URL"))
+_local_cache_generation = {"generation": None}
+
+
+def clear():
+    _local_cache.clear()
+    if _shared_cache is not None:
+        _shared_cache.clear()
+
+
+def get_cache_key(generation):
+    return json.dumps([generation, request.path, sorted(request.args.items(multi=True))])
+
+
+def get_cached_entry(key):
+    entry = _local_cache.get(key)
+    if entry is None and _shared_cache is not None:
+        entry = _shared_cache.get(key)
+        if entry is not None:
+            _local_cache.put(key, entry, len(entry["body"].encode('utf-8')))
+    return entry
+
+
+def store_entry(key, body, mimetype):
+    entry = {"body": body.decode('utf-8'), "mimetype": mimetype, "etag": hashlib.sha256(body).hexdigest()}
+    if len(body) <= constants.RESPONSE_CACHE_MAX_BYTES:
+        _local_cache.put(key, entry, len(body))
+        if _shared_cache is not None:
+            _shared_cache.put(key, entry)
+    return entry
+
+
+def iter_and_store(key, response):
+    # Sends a streamed body on as it's generated and caches it once it's complete. Bodies too large
+    # to cache stop being collected, and ones cut short by the client going away aren't cached.
+    chunks = []
+    size = 0
+    try:
+        for chunk in response.iter_encoded():
+            size = size + len(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+                if size > constants.RESPONSE_CACHE_MAX_BYTES:
+                    chunks = None
+            yield chunk
+        if chunks is not None:
+            store_entry(key, b''.join(chunks), response.mimetype)
+    finally:
+        response.close()
+
+
+def set_cache_control(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = constants.RESPONSE_CACHE_MAX_AGE_SECONDS
+
+
+def build_response(entry):
+    response = Response(entry["body"], mimetype=entry["mimetype"])
+    response.set_etag(entry["etag"])
+    set_cache_control(response)
+    return response.make_conditional(request)
+
+
+def cached_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        generation = utils.get_data_generation()
+        if generation != _local_cache_generation["generation"]:
+            _local_cache.clear()
+            _local_cache_generation["generation"] = generation
+
+        key = get_cache_key(generation)
+        entry = get_cached_entry(key)
+        if entry is not None:
+            return build_response(entry)
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+
+        # Streamed responses still stream the first time, but only get an ETag once they're cached
+        if response.is_streamed:
+            streamed_response = Response(iter_and_store(key, response), headers=response.headers)
+            set_cache_control(streamed_response)
+            return streamed_response
+
+        return build_response(store_entry(key, response.get_data(), response.mimetype))
+
+    return wrapper
@@ -0,0 +1,81 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from flask import Response, stream_with_context
+import constants
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+##########################################
+# Lean Serialization
+#
+# For list endpoints, selects just the columns named in a marshmallow
+# schema's Meta.fields as plain tuples and encodes them directly, instead of
+# loading ORM instances and dumping them field by field. The schemas stay
+# the source of truth for which fields are sent. Uses orjson when it's
+# installed and the standard library otherwise.
+##########################################
+
+
+def encode_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    # Postgres returns sums and averages as Decimals
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=encode_default).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), default=encode_default)
+
+
+def get_schema_columns(schema, query):
+    # Fields the model doesn't have are left out, as marshmallow leaves out missing attributes
+    model = query.column_descriptions[0]["entity"]
+    return [model.__table__.columns[name] for name in schema.Meta.fields if name in model.__table__.columns]
+
+
+def iter_schema_rows(query, schema):
+    columns = get_schema_columns(schema, query)
+    names = [column.name for column in columns]
+    primary_key_columns = list(query.column_descriptions[0]["entity"].__table__.primary_key.columns)
+
+    # Rows repeated by joins are skipped, as loading ORM instances would
+    seen_primary_keys = set()
+    for row in query.with_entities(*columns, *primary_key_columns).yield_per(constants.SERIALIZATION_CHUNK_SIZE):
+        primary_key = tuple(row[len(columns):])
+        if primary_key in seen_primary_keys:
+            continue
+        seen_primary_keys.add(primary_key)
+        yield dict(zip(names, row[:len(columns)]))
+
+
+def dump_rows(query, schema):
+    return list(iter_schema_rows(query, schema))
+
+
+def iter_json_array(query, schema):
+    yield '['
+    chunk = []
+    is_first_chunk = True
+    for row in iter_schema_rows(query, schema):
+        chunk.append(row)
+        if len(chunk) >= constants.SERIALIZATION_CHUNK_SIZE:
+            yield ('' if is_first_chunk else ',') + encode_json(chunk)[1:-1]
+            chunk = []
+            is_first_chunk = False
+    if chunk:
+        yield ('' if is_first_chunk else ',') + encode_json(chunk)[1:-1]
+    yield ']'
+
+
+# Streams the query's rows as a JSON array, encoding SERIALIZATION_CHUNK_SIZE rows at a time
+def json_array_response(query, schema):
+    return Response(stream_with_context(iter_json_array(query, schema)), mimetype='application/json')
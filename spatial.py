@@ -0,0 +1,93 @@
+import math
+from models import Property
+import constants
+import utils
+
+
+class GridIndex:
+    # Buckets points into fixed-size latitude/longitude cells, so a bounding box only has to look
+    # at the cells it overlaps
+    def __init__(self, points, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        for point in points:
+            self.cells.setdefault(self.get_cell(point["latitude"], point["longitude"]), []).append(point)
+
+        rows = [row for row, column in self.cells]
+        columns = [column for row, column in self.cells]
+        self.bounds = (min(rows), max(rows), min(columns), max(columns)) if self.cells else None
+
+    def __len__(self):
+        return sum(len(points) for points in self.cells.values())
+
+    def get_cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    def search(self, min_lat, max_lat, min_lon, max_lon):
+        if self.bounds is None:
+            return []
+
+        min_row, min_column = self.get_cell(min_lat, min_lon)
+        max_row, max_column = self.get_cell(max_lat, max_lon)
+        min_row, max_row = max(min_row, self.bounds[0]), min(max_row, self.bounds[1])
+        min_column, max_column = max(min_column, self.bounds[2]), min(max_column, self.bounds[3])
+
+        results = []
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                for point in self.cells.get((row, column), []):
+                    if min_lat <= point["latitude"] <= max_lat and min_lon <= point["longitude"] <= max_lon:
+                        results.append(point)
+        return results
+
+
+def get_property_points():
+    properties = Property.query.with_entities(Property.id, Property.parcel_id, Property.address, Property.group_id, Property.latitude, Property.longitude)\
+        .filter(Property.latitude.isnot(None))\
+        .filter(Property.longitude.isnot(None))
+    for property_id, parcel_id, address, group_id, latitude, longitude in properties:
+        yield {"id": property_id, "parcel_id": parcel_id, "address": address, "group_id": group_id, "latitude": latitude, "longitude": longitude}
+
+
+def build_index():
+    return GridIndex(get_property_points(), constants.SPATIAL_GRID_CELL_DEGREES)
+
+
+# The grid is rebuilt once it is older than SPATIAL_INDEX_TTL_SECONDS or the data changes
+_index_cache = utils.GenerationCache(build_index, constants.SPATIAL_INDEX_TTL_SECONDS)
+
+
+def get_index():
+    return _index_cache.get()
+
+
+def cluster_points(points, min_lat, max_lat, min_lon, max_lon):
+    # Clusters snap to a grid of power-of-two sized cells, so they stay put as the map pans
+    span = max(max_lat - min_lat, max_lon - min_lon, constants.SPATIAL_GRID_CELL_DEGREES)
+    cell_size = 2 ** math.ceil(math.log2(span / constants.SPATIAL_CLUSTER_GRID_SIZE))
+
+    cells = {}
+    for point in points:
+        cells.setdefault((math.floor(point["latitude"] / cell_size), math.floor(point["longitude"] / cell_size)), []).append(point)
+
+    clusters = []
+    for cell_points in cells.values():
+        clusters.append({
+            "count": len(cell_points),
+            "latitude": sum(point["latitude"] for point in cell_points) / len(cell_points),
+            "longitude": sum(point["longitude"] for point in cell_points) / len(cell_points),
+            "property": cell_points[0] if len(cell_points) == 1 else None,
+        })
+    return clusters
+
+
+# Properties inside the bounding box. At low zoom levels, or when there are too many to send
+# individually, they come back grouped into clusters instead.
+def get_properties_in_bbox(min_lat, max_lat, min_lon, max_lon, zoom=None):
+    points = get_index().search(min_lat, max_lat, min_lon, max_lon)
+    should_cluster = len(points) > constants.BBOX_MAX_PROPERTIES or \
+        (zoom is not None and zoom < constants.SPATIAL_CLUSTER_MAX_ZOOM)
+
+    if should_cluster:
+        return {"total_results": len(points), "clustered": True, "properties": [], "clusters": cluster_points(points, min_lat, max_lat, min_lon, max_lon)}
+    return {"total_results": len(points), "clustered": False, "properties": points, "clusters": []}
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import math
+from models import db, Property, LandlordScorecard, MapTile
+import constants
+import utils
+
+
+##########################################
+# Map Tiles
+#
+# Properties are bucketed into Web Mercator (slippy map) tiles as small
+# GeoJSON feature collections carrying each property's ID, owner group and
+# grade color. Tiles are generated for every zoom level in
+# MAP_TILE_MIN_ZOOM..MAP_TILE_MAX_ZOOM as part of the derived data refresh,
+# stored in the map_tile table, and cached by each worker after first use.
+##########################################
+
+
+def get_tile_coordinates(latitude, longitude, zoom):
+    scale = 2 ** zoom
+    latitude = max(min(latitude, constants.MAP_TILE_MAX_LATITUDE), -constants.MAP_TILE_MAX_LATITUDE)
+    x = int((longitude + 180) / 360 * scale)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * scale)
+    return (min(x, scale - 1), min(y, scale - 1))
+
+
+def get_tile_body(features):
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(',', ':'))
+
+
+def get_etag(body):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def get_property_features():
+    properties = db.session.query(Property.id, Property.group_id, Property.latitude, Property.longitude, LandlordScorecard.color)\
+        .outerjoin(LandlordScorecard, LandlordScorecard.group_id == Property.group_id)\
+        .filter(Property.latitude.isnot(None))\
+        .filter(Property.longitude.isnot(None))
+    for property_id, group_id, latitude, longitude, color in properties:
+        yield (latitude, longitude, {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(longitude, 6), round(latitude, 6)]},
+            "properties": {"id": property_id, "group_id": group_id, "color": color},
+        })
+
+
+def build_tiles():
+    features_by_tile = {}
+    for latitude, longitude, feature in get_property_features():
+        for zoom in range(constants.MAP_TILE_MIN_ZOOM, constants.MAP_TILE_MAX_ZOOM + 1):
+            x, y = get_tile_coordinates(latitude, longitude, zoom)
+            features_by_tile.setdefault((zoom, x, y), []).append(feature)
+
+    for (z, x, y), features in features_by_tile.items():
+        body = get_tile_body(features)
+        yield {"z": z, "x": x, "y": y, "etag": get_etag(body), "body": body}
+
+
+# Replaces every stored tile. Doesn't commit.
+def refresh_tiles():
+    db.session.query(MapTile).delete(synchronize_session=False)
+    tiles = list(build_tiles())
+    for start in range(0, len(tiles), constants.BULK_LOAD_BATCH_SIZE):
+        db.session.execute(MapTile.__table__.insert(), tiles[start:start + constants.BULK_LOAD_BATCH_SIZE])
+    return len(tiles)
+
+
+EMPTY_TILE_BODY = get_tile_body([])
+EMPTY_TILE = (get_etag(EMPTY_TILE_BODY), EMPTY_TILE_BODY)
+
+# Each worker keeps the tiles it has served, until the data generation changes
+_tile_cache = utils.GenerationCache(dict)
+
+
+# Returns (etag, body) for a tile, or None for zoom levels that aren't generated
+def get_tile(z, x, y):
+    if not constants.MAP_TILE_MIN_ZOOM <= z <= constants.MAP_TILE_MAX_ZOOM:
+        return None
+
+    cached_tiles = _tile_cache.get()
+    key = (z, x, y)
+    if key not in cached_tiles:
+        tile = MapTile.query.with_entities(MapTile.etag, MapTile.body).filter_by(z=z, x=x, y=y).first()
+        # Only tiles that exist are kept, so requests for arbitrary empty tiles can't grow the cache
+        if tile is None:
+            return EMPTY_TILE
+        cached_tiles[key] = tuple(tile)
+    return cached_tiles[key]
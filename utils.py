@@ -1,8 +1,9 @@
 from decimal import Decimal
-from datetime import date, timedelta
-from models import db, Landlord, Property, Alias, Eviction, CodeCase
+from datetime import date, datetime, timedelta
+from models import db, Landlord, Property, Alias, Eviction, CodeCase, CityStats, LandlordScorecard, DataGeneration
 from sqlalchemy.sql import func
-from sqlalchemy import or_
+from sqlalchemy import or_, case, union_all
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from num2words import num2words
 import usaddress
 import re
@@ -10,12 +11,18 @@ import constants
 import math
 import utils
 import statistics
+import time
+import base64
+import json
+import functools
+import logging
 
 
 class PaginatedResults:
-    def __init__(self, items, total):
+    def __init__(self, items, total, next_cursor=None):
         self.items = items
         self.total = total
+        self.next_cursor = next_cursor
 
 
 def get_landlord(landlord_id):
@@ -57,6 +64,10 @@ def add_grade_and_color(landlord_stats, average_stats):
     return landlord_stats
 
 
+def clean_name(name):
+    return ''.join(name.split()).lower()
+
+
 def replace_none_with_zero(some_dict):
     return { k: (0 if v is None else v) for k, v in some_dict.items() }
 
@@ -64,6 +75,9 @@ def replace_none_with_zero(some_dict):
 def get_std_devs(value, average, std_dev):
     if value is None:
         value = 0.0
+    # With no spread across the city yet, nobody is above or below average
+    if not std_dev:
+        return 0.0
     return (average - value) / std_dev
 
 
@@ -108,6 +122,10 @@ def get_letter_grade_and_color(value):
     return {"grade": "{}{}".format(letter, modifier), "color":constants.GRADE_COLORS[letter]}
 
 def calculate_landlord_score(stats):
+    return get_letter_grade_and_color(calculate_landlord_grade_score(stats))
+
+
+def calculate_landlord_grade_score(stats):
     total_score = 0
     has_failing_grade = False
     for component in constants.GRADE_COMPONENTS:
@@ -122,7 +140,7 @@ def calculate_landlord_score(stats):
     if has_failing_grade and grade_score >= 3.0:
         grade_score = 2.5
 
-    return get_letter_grade_and_color(grade_score)
+    return grade_score
 
 
 
@@ -193,11 +211,49 @@ def get_code_violations_for_group(group_id):
         return 0
     return value[1]
 
+# Queries behind the per-landlord endpoints. indexes.py runs EXPLAIN on these to check they use indexes.
+def landlord_query(group_id):
+    return Landlord.query.filter_by(group_id=group_id)
+
+def landlord_aliases_query(group_id):
+    return Alias.query.filter_by(group_id=group_id)
+
+def landlord_properties_query(group_id):
+    return Property.query.filter_by(group_id=group_id)
+
+def landlord_code_cases_query(group_id, case_types):
+    one_year_ago = date.today() - timedelta(days=365) 
+    return CodeCase.query.filter(CodeCase.case_type.in_(case_types))\
+        .filter(CodeCase.apply_date >= one_year_ago) \
+        .join(Property, Property.parcel_id==CodeCase.parcel_id)\
+        .filter(Property.group_id == group_id)
+
+def landlord_evictions_query(group_id):
+    one_year_ago = date.today() - timedelta(days=365) 
+    return Eviction.query.join(Alias, Alias.name == Eviction.matched_name)\
+        .filter(Eviction.case_date >= one_year_ago)\
+        .filter(Alias.group_id == group_id)
+
+def landlord_unsafe_unfit_properties_query(group_id):
+    one_year_ago = date.today() - timedelta(days=365) 
+    return Property.query.filter(Property.group_id == group_id).join(CodeCase, Property.parcel_id==CodeCase.parcel_id) \
+        .filter(CodeCase.case_type == constants.UNSAFE_UNFIT_TYPE) \
+        .filter(CodeCase.apply_date >= one_year_ago)
+
+def property_unsafe_unfit_cases_query(parcel_id):
+    one_year_ago = date.today() - timedelta(days=365) 
+    return CodeCase.query.filter(CodeCase.parcel_id == parcel_id)\
+        .filter(CodeCase.case_type == constants.UNSAFE_UNFIT_TYPE) \
+        .filter(CodeCase.apply_date >= one_year_ago)
+
 def get_landlord_stats(group_id):
     units_for_group = get_landlord_unit_count(group_id)
     total_evictions = get_evictions_for_group(group_id)
     total_code_violations = get_code_violations_for_group(group_id)
 
+    return build_landlord_stats(units_for_group, total_evictions, total_code_violations)
+
+def build_landlord_stats(units_for_group, total_evictions, total_code_violations):
     denominator = 1 if units_for_group is None else units_for_group
 
     return {
@@ -208,7 +264,15 @@ def get_landlord_stats(group_id):
         "code_violations_per_unit":  total_code_violations / denominator
     }
 
-def get_city_average_stats():
+def get_std_dev(values):
+    # A new or partly loaded database may not have the two data points stdev needs yet
+    if len(values) < 2:
+        logging.warning(f"Only {len(values)} owner groups to compute a standard deviation from; using 0.")
+        return 0.0
+    return statistics.stdev(values)
+
+
+def compute_city_average_stats():
     one_year_ago = date.today() - timedelta(days=365) 
     total_eviction_count = Eviction.query.filter(Eviction.case_date >= one_year_ago).count()
     total_code_violation_count = CodeCase.query.filter(CodeCase.apply_date >= one_year_ago).filter(CodeCase.case_type == constants.CODE_VIOLATIONS_TYPE).count()
@@ -219,11 +283,11 @@ def get_city_average_stats():
 
     eviction_counts_per_unit = []
     for group_id, eviction_count in evictions_by_group:
-        if group_id in landlords_with_counts:
+        if group_id in landlords_with_counts and landlords_with_counts[group_id] > 0:
             eviction_counts_per_unit.append(eviction_count/landlords_with_counts[group_id])
         else:
             eviction_counts_per_unit.append(eviction_count)
-    stddev_eviction_counts = statistics.stdev(eviction_counts_per_unit)
+    stddev_eviction_counts = get_std_dev(eviction_counts_per_unit)
 
     code_violations_by_group = get_all_code_violations_by_group_id()
 
@@ -234,16 +298,292 @@ def get_city_average_stats():
         else:
             code_violations_per_unit.append(code_violation_count)
 
-    stddev_code_violation_counts = statistics.stdev(code_violations_per_unit)
+    stddev_code_violation_counts = get_std_dev(code_violations_per_unit)
+
+    # Before any ROP cases are loaded there are no units to average over
+    if total_unit_count == 0:
+        logging.warning("No rental units found for the city stats; using averages of 0.")
 
     return {
-        "mean_evictions_per_unit": total_eviction_count / total_unit_count,
-        "mean_code_violations_per_unit": total_code_violation_count / total_unit_count,
+        "mean_evictions_per_unit": total_eviction_count / total_unit_count if total_unit_count else 0.0,
+        "mean_code_violations_per_unit": total_code_violation_count / total_unit_count if total_unit_count else 0.0,
         "std_dev_evictions": stddev_eviction_counts,
         "std_dev_code_violations": stddev_code_violation_counts,
     }
 
 
+# The data generation goes up every time a populate script swaps in new data or the derived
+# data is refreshed. Per-worker caches remember the generation they were built from and
+# rebuild themselves when it changes.
+_data_generation_cache = {"generation": None, "checked_at": None}
+
+
+def bump_data_generation(source):
+    generation = DataGeneration(source=source)
+    db.session.add(generation)
+    db.session.flush()
+
+    _data_generation_cache["checked_at"] = None
+    return generation
+
+
+def get_data_generation():
+    checked_at = _data_generation_cache["checked_at"]
+    if checked_at is None or time.monotonic() - checked_at > constants.DATA_GENERATION_CHECK_SECONDS:
+        try:
+            generation = DataGeneration.query.with_entities(func.max(DataGeneration.id)).scalar()
+        except (OperationalError, ProgrammingError):
+            # The table is created by the first populate or refresh run; until then there's only generation 0
+            db.session.rollback()
+            generation = None
+        _data_generation_cache["generation"] = 0 if generation is None else generation
+        _data_generation_cache["checked_at"] = time.monotonic()
+    return _data_generation_cache["generation"]
+
+
+class GenerationCache:
+    # A value each worker builds on first use and keeps until the data generation changes or,
+    # if given, `ttl_seconds` pass
+    def __init__(self, build, ttl_seconds=None):
+        self.build = build
+        self.ttl_seconds = ttl_seconds
+        self.value = None
+        self.generation = None
+        self.loaded_at = None
+
+    def get(self):
+        generation = get_data_generation()
+        if self.loaded_at is None or generation != self.generation or \
+                (self.ttl_seconds is not None and time.monotonic() - self.loaded_at > self.ttl_seconds):
+            self.value = self.build()
+            self.generation = generation
+            self.loaded_at = time.monotonic()
+        return self.value
+
+    def invalidate(self):
+        self.loaded_at = None
+
+
+def load_city_average_stats():
+    # Requests only read snapshots. Until a refresh saves the first one, the stats are computed on the fly
+    snapshot = get_latest_city_stats_snapshot()
+    return snapshot.as_dict() if snapshot is not None else compute_city_average_stats()
+
+
+# Per-worker copy of the latest city stats snapshot, so requests don't need to hit the database
+_city_stats_cache = GenerationCache(load_city_average_stats, constants.CITY_STATS_CACHE_TTL_SECONDS)
+
+
+def refresh_city_stats():
+    snapshot = CityStats(**compute_city_average_stats())
+    db.session.add(snapshot)
+    db.session.commit()
+
+    _city_stats_cache.invalidate()
+    return snapshot
+
+
+def get_latest_city_stats_snapshot():
+    try:
+        return CityStats.query.order_by(CityStats.version.desc()).first()
+    except (OperationalError, ProgrammingError):
+        # The table is created by the first refresh run
+        db.session.rollback()
+        return None
+
+
+def is_city_stats_snapshot_stale(snapshot):
+    max_age = timedelta(seconds=constants.CITY_STATS_MAX_AGE_SECONDS)
+    return snapshot is None or snapshot.created_at < datetime.utcnow() - max_age
+
+
+def get_city_average_stats():
+    return dict(_city_stats_cache.get())
+
+
+def refresh_landlord_scorecards(city_stats_snapshot=None, group_ids=None):
+    if city_stats_snapshot is None:
+        city_stats_snapshot = get_latest_city_stats_snapshot() or refresh_city_stats()
+    city_stats = city_stats_snapshot.as_dict()
+
+    # One grouped query per metric for every group at once, rather than one set per group
+    unit_counts_query = landlords_with_unit_count_query()
+    evictions_counts_query = evictions_query()
+    code_violation_counts_query = code_violations_query()
+    property_counts_query = Property.query\
+        .with_entities(Property.group_id, func.count(Property.id).label('property_count'))\
+        .group_by(Property.group_id)
+    landlord_group_ids_query = Landlord.query.with_entities(Landlord.group_id).filter(Landlord.group_id != None).distinct()
+    scorecards_query = db.session.query(LandlordScorecard)
+
+    # After an incremental load, only the groups whose data changed need recounting
+    if group_ids is not None:
+        group_ids = list(group_ids)
+        unit_counts_query = unit_counts_query.filter(Property.group_id.in_(group_ids))
+        evictions_counts_query = evictions_counts_query.filter(Alias.group_id.in_(group_ids))
+        code_violation_counts_query = code_violation_counts_query.filter(Property.group_id.in_(group_ids))
+        property_counts_query = property_counts_query.filter(Property.group_id.in_(group_ids))
+        landlord_group_ids_query = landlord_group_ids_query.filter(Landlord.group_id.in_(group_ids))
+        scorecards_query = scorecards_query.filter(LandlordScorecard.group_id.in_(group_ids))
+
+    unit_counts = dict(unit_counts_query.all())
+    eviction_counts = dict(evictions_counts_query.all())
+    code_violation_counts = dict(code_violation_counts_query.all())
+    property_counts = dict(property_counts_query.all())
+
+    scorecards = []
+    for group_id, in landlord_group_ids_query:
+        stats = build_landlord_stats(unit_counts.get(group_id),
+                                     eviction_counts.get(group_id, 0),
+                                     code_violation_counts.get(group_id, 0))
+        stats = grade_landlord_stats(stats, city_stats)
+        stats["property_count"] = property_counts.get(group_id, 0)
+
+        scorecards.append(LandlordScorecard(group_id=group_id,
+                                            city_stats_version=city_stats_snapshot.version,
+                                            **stats))
+
+    # Grades are relative to the city stats, so the other groups are regraded from their stored counts
+    regraded_scorecards = []
+    if group_ids is not None:
+        regraded_scorecards = get_regraded_scorecards(city_stats_snapshot, set(group_ids))
+        db.session.bulk_update_mappings(LandlordScorecard, regraded_scorecards)
+
+    scorecards_query.delete(synchronize_session=False)
+    db.session.bulk_save_objects(scorecards)
+    db.session.commit()
+
+    return len(scorecards) + len(regraded_scorecards)
+
+
+def grade_landlord_stats(stats, city_stats):
+    stats = add_grade_and_color(stats, city_stats)
+    stats["score"] = calculate_landlord_grade_score(stats)
+    stats.update(get_letter_grade_and_color(stats["score"]))
+    return stats
+
+
+# Scorecards for every group not in `skipped_group_ids`, regraded against the snapshot without recounting
+def get_regraded_scorecards(city_stats_snapshot, skipped_group_ids):
+    city_stats = city_stats_snapshot.as_dict()
+    stored_scorecards = db.session.query(LandlordScorecard.group_id,
+                                         LandlordScorecard.evictions_per_unit,
+                                         LandlordScorecard.code_violations_per_unit)
+
+    regraded_scorecards = []
+    for group_id, evictions_per_unit, code_violations_per_unit in stored_scorecards:
+        if group_id in skipped_group_ids:
+            continue
+        stats = grade_landlord_stats({"evictions_per_unit": evictions_per_unit, "code_violations_per_unit": code_violations_per_unit}, city_stats)
+        regraded_scorecards.append(dict(stats, group_id=group_id,
+                                        city_stats_version=city_stats_snapshot.version,
+                                        updated_at=datetime.utcnow()))
+    return regraded_scorecards
+
+
+def compute_landlord_grades(group_id):
+    return compute_landlord_grades_bulk([group_id])[group_id]
+
+
+def compute_landlord_grades_bulk(group_ids):
+    city_stats = get_city_average_stats()
+
+    # One grouped query per metric, restricted to the requested groups
+    unit_counts = dict(landlords_with_unit_count_query().filter(Property.group_id.in_(group_ids)).all())
+    eviction_counts = dict(evictions_query().filter(Alias.group_id.in_(group_ids)).all())
+    code_violation_counts = dict(code_violations_query().filter(Property.group_id.in_(group_ids)).all())
+
+    grades_map = {}
+    for group_id in group_ids:
+        landlord_stats = build_landlord_stats(unit_counts.get(group_id),
+                                              eviction_counts.get(group_id, 0),
+                                              code_violation_counts.get(group_id, 0))
+        grades = add_grade_and_color(landlord_stats, city_stats)
+        grades.update(calculate_landlord_score(grades))
+        grades_map[group_id] = grades
+
+    return grades_map
+
+
+def landlords_with_scorecards_query(group_ids):
+    return db.session.query(Landlord, LandlordScorecard)\
+        .outerjoin(LandlordScorecard, LandlordScorecard.group_id == Landlord.group_id)\
+        .filter(Landlord.group_id.in_(group_ids))
+
+
+def get_scorecard_grades(scorecard):
+    # updated_at is left out: it's bookkeeping for the refresh, and JSON encoders disagree on how to write it
+    grades = scorecard.as_dict()
+    del grades["updated_at"]
+    return grades
+
+
+def get_grades_from_scorecard(landlord, scorecard):
+    # Fall back to computing the grades live if the scorecards haven't been refreshed for this group yet
+    grades = get_scorecard_grades(scorecard) if scorecard is not None else compute_landlord_grades(landlord.group_id)
+    grades.update(landlord.as_dict())
+    return grades
+
+
+# Returns None if there's no such landlord
+def get_landlord_grades(group_id):
+    landlord_and_scorecard = landlords_with_scorecards_query([group_id]).first()
+    if landlord_and_scorecard is None:
+        return None
+
+    landlord, scorecard = landlord_and_scorecard
+    return get_grades_from_scorecard(landlord, scorecard)
+
+
+# Everything on a landlord's page in at most five queries: the landlord with its scorecard, and
+# then only what the requested sections need of its aliases, properties, code cases and evictions.
+# List sections are built with `dump_rows(query, section)`, which returns the query's rows as dicts.
+# Returns None if there's no such landlord.
+def get_landlord_profile(group_id, sections, dump_rows):
+    landlord_and_scorecard = landlords_with_scorecards_query([group_id]).first()
+    if landlord_and_scorecard is None:
+        return None
+
+    landlord, scorecard = landlord_and_scorecard
+    profile = {"landlord": landlord}
+
+    if "grades" in sections:
+        profile["grades"] = get_grades_from_scorecard(landlord, scorecard)
+
+    if "aliases" in sections:
+        profile["aliases"] = dump_rows(landlord_aliases_query(group_id), "aliases")
+
+    if "properties" in sections or "unsafe_unfit" in sections:
+        profile["properties"] = dump_rows(landlord_properties_query(group_id), "properties")
+
+    # Code violations and unsafe & unfit properties come from one query for both case types
+    if "code_violations" in sections or "unsafe_unfit" in sections:
+        code_cases = dump_rows(landlord_code_cases_query(group_id, [constants.CODE_VIOLATIONS_TYPE, constants.UNSAFE_UNFIT_TYPE]), "code_violations")
+        profile["code_violations"] = [code_case for code_case in code_cases if code_case["case_type"] == constants.CODE_VIOLATIONS_TYPE]
+        unsafe_unfit_parcel_ids = {code_case["parcel_id"] for code_case in code_cases if code_case["case_type"] == constants.UNSAFE_UNFIT_TYPE}
+        profile["unsafe_unfit"] = [prop for prop in profile["properties"] if prop["parcel_id"] in unsafe_unfit_parcel_ids]
+
+    if "evictions" in sections:
+        profile["evictions"] = dump_rows(landlord_evictions_query(group_id), "evictions")
+
+    return profile
+
+
+def get_landlord_grades_bulk(group_ids):
+    landlords_and_scorecards = landlords_with_scorecards_query(group_ids).all()
+
+    missing_group_ids = [landlord.group_id for landlord, scorecard in landlords_and_scorecards if scorecard is None]
+    computed_grades = compute_landlord_grades_bulk(missing_group_ids) if missing_group_ids else {}
+
+    grades_map = {}
+    for landlord, scorecard in landlords_and_scorecards:
+        grades = get_scorecard_grades(scorecard) if scorecard is not None else computed_grades[landlord.group_id]
+        grades.update(landlord.as_dict())
+        grades_map[landlord.group_id] = grades
+
+    return grades_map
+
+
 def replace_ordinals(text):
     match = re.search('((\d+)(st|nd|rd|th))', text) 
     
@@ -255,6 +595,25 @@ def replace_ordinals(text):
     return text
 
 
+# Search queries repeat constantly and usaddress runs a CRF model on every call, so normalized
+# and parsed addresses are memoized. populate_db shares the parse cache for property addresses.
+@functools.lru_cache(maxsize=constants.ADDRESS_CACHE_SIZE)
+def normalize_address(text):
+    return replace_ordinals(text)
+
+
+@functools.lru_cache(maxsize=constants.ADDRESS_CACHE_SIZE)
+def parse_address(text):
+    return tuple(usaddress.parse(text))
+
+
+def get_address_cache_info():
+    return {
+        "normalize_address": normalize_address.cache_info()._asdict(),
+        "parse_address": parse_address.cache_info()._asdict(),
+    }
+
+
 def get_address_dict(parsed_address_tuple_list):
     address_dict = {}
     for value, field in parsed_address_tuple_list:
@@ -263,8 +622,8 @@ def get_address_dict(parsed_address_tuple_list):
 
 
 def get_address_filter_criteria(search_string):
-    search_string = utils.replace_ordinals(search_string)
-    parsed_address_tuple_list = usaddress.parse(search_string)
+    search_string = normalize_address(search_string)
+    parsed_address_tuple_list = parse_address(search_string)
     parsed_address = get_address_dict(parsed_address_tuple_list)
 
     if "AddressNumber" in parsed_address and "StreetName" in parsed_address:
@@ -282,10 +641,40 @@ def get_landlord_filter_criteria(search_string):
     return filter_criteria
 
 
+# Higher is more relevant. Postgres ranks with pg_trgm; elsewhere (e.g. SQLite), prefix
+# matches on the address rank first, then prefix matches on an owner name.
+def get_address_relevance(search_string):
+    if db.engine.dialect.name == "postgresql":
+        return func.word_similarity(search_string, Property.address)
+    return case((Property.address.ilike("{}%".format(search_string)), 2), else_=0)
+
+
+def get_landlord_relevance(search_string):
+    if db.engine.dialect.name == "postgresql":
+        return func.word_similarity(search_string, Alias.name)
+    return case((Alias.name.ilike("{}%".format(search_string)), 1), else_=0)
+
+
+# Properties matching on address and properties whose owner has a matching alias are found
+# separately, so each side can use its own trigram index, and only the matches are ranked
+def search_matches_query(text):
+    address_matches = db.session.query(Property.id.label("property_id"), get_address_relevance(text).label("relevance"))\
+        .filter(get_address_filter_criteria(text))
+    landlord_matches = db.session.query(Property.id, get_landlord_relevance(text))\
+        .join(Alias, Alias.group_id == Property.group_id)\
+        .filter(get_landlord_filter_criteria(text))
+    matches = union_all(address_matches, landlord_matches).subquery()
+
+    return db.session.query(matches.c.property_id, func.max(matches.c.relevance).label("relevance"))\
+        .group_by(matches.c.property_id)
+
+
 def perform_search(text, max_results):
-    filter_criteria = get_address_filter_criteria(text) | get_landlord_filter_criteria(text)
+    matches = search_matches_query(text).subquery()
 
-    results = Property.query.filter(filter_criteria).join(Alias, Alias.group_id==Property.group_id).order_by(Property.address).limit(max_results)
+    results = Property.query.join(matches, matches.c.property_id == Property.id)\
+        .order_by(matches.c.relevance.desc(), Property.address)\
+        .limit(max_results)
     return results
 
 
@@ -293,44 +682,116 @@ def get_unsafe_unfit_properties(landlord_id):
     return Property.query.filter(Property.owner_id == landlord_id).filter(Property.unsafe_unfit_count > 0).all()
 
 
-def sort_landlords_by_grade(sort_direction, page_number, page_size):
-    landlord_list = []
-    landlord_objects = Landlord.query.all()
-    city_stats = utils.get_city_average_stats()
+def get_ranking_columns(sort_by):
+    column_name = constants.RANKING_SORT_COLUMNS.get(sort_by)
+    if column_name is None:
+        column_name = constants.RANKING_SORT_COLUMNS[constants.DEFAULT_SORT_BY]
 
-    for landlord in landlord_objects:
-        landlord = landlord.as_dict()
-        grades = utils.add_grade_and_color(landlord, city_stats)
-        grades.update(utils.calculate_landlord_score(grades))
+    # Ties are broken on the landlord's primary key, so the ordering is stable across pages
+    if column_name in LandlordScorecard.__table__.columns:
+        return LandlordScorecard.__table__.columns[column_name], Landlord.__table__.columns["id"]
+    return Landlord.__table__.columns[column_name], Landlord.__table__.columns["id"]
 
-        landlord["grade"] = grades["grade"]
-        landlord_list.append(landlord)
 
-    reverse = False if sort_direction == "asc" else True
-    landlord_list.sort(key=lambda x: x["grade"], reverse=reverse)
+def is_ranking_column_nullable(column):
+    # Scorecard columns are outer joined, so they're NULL for landlords without a scorecard yet
+    return column.nullable or column.table is LandlordScorecard.__table__
 
-    first_result = (page_number-1) * page_size
-    return PaginatedResults(landlord_list[first_result:first_result + page_size], len(landlord_list))
 
+def is_ranking_descending(sort_by, sort_direction):
+    descending = sort_direction != "asc"
 
-# TODO: Fix this function
-def get_ranked_landlords(sort_by, sort_direction, page_number, page_size):
+    # Lower scores are worse grades, and sorting grades descending puts the worst (F) first
     if sort_by == "grade":
-        return sort_landlords_by_grade(sort_direction, page_number, page_size)
+        descending = not descending
+    return descending
+
+
+def get_ranking_order(sort_by, sort_direction):
+    ranking_criteria, tiebreaker = get_ranking_columns(sort_by)
+    descending = is_ranking_descending(sort_by, sort_direction)
+
+    order = ranking_criteria.desc() if descending else ranking_criteria.asc()
+    if is_ranking_column_nullable(ranking_criteria):
+        order = order.nullslast()
+
+    return [order, tiebreaker.desc() if descending else tiebreaker.asc()]
+
+
+def get_ranking_keyset_filter(sort_by, sort_direction, value, tiebreaker_value):
+    ranking_criteria, tiebreaker = get_ranking_columns(sort_by)
+    descending = is_ranking_descending(sort_by, sort_direction)
+
+    def comes_after(column, column_value):
+        return column < column_value if descending else column > column_value
+
+    # Nulls always sort last, so once we reach them only the tiebreaker moves the page forward
+    if value is None:
+        return ranking_criteria.is_(None) & comes_after(tiebreaker, tiebreaker_value)
+
+    filter_criteria = comes_after(ranking_criteria, value) | ((ranking_criteria == value) & comes_after(tiebreaker, tiebreaker_value))
+    if is_ranking_column_nullable(ranking_criteria):
+        filter_criteria = filter_criteria | ranking_criteria.is_(None)
+    return filter_criteria
+
+
+def encode_ranking_cursor(sort_by, sort_direction, ranked_landlord):
+    ranking_criteria, tiebreaker = get_ranking_columns(sort_by)
+    cursor = [sort_by, sort_direction, ranked_landlord[ranking_criteria.name], ranked_landlord[tiebreaker.name]]
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
 
-    ranking_criteria = getattr(Landlord, sort_by)
-    if sort_direction == "asc":
-        results = Landlord.query.order_by(ranking_criteria.is_(None), ranking_criteria.asc()).paginate(page_number, page_size)
-    else:
-        results = Landlord.query.order_by(ranking_criteria.is_(None), ranking_criteria.desc()).paginate(page_number, page_size)
-    landlord_list = []
-    city_stats = utils.get_city_average_stats()
-    for landlord in results.items:
-        landlord = landlord.as_dict()
-        grades = utils.add_grade_and_color(landlord, city_stats)
-        grades.update(utils.calculate_landlord_score(grades))
 
-        landlord["grade"] = grades["grade"]
-        landlord_list.append(landlord)
+def decode_ranking_cursor(sort_by, sort_direction, cursor):
+    try:
+        cursor_sort_by, cursor_sort_direction, value, tiebreaker_value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
 
+    if cursor_sort_by != sort_by or cursor_sort_direction != sort_direction:
+        raise ValueError("Cursor does not match the requested sort order")
+    # Values are compared against a column, so only numbers, strings and nulls can be valid
+    if not all(v is None or isinstance(v, (int, float, str)) for v in [value, tiebreaker_value]):
+        raise ValueError("Invalid cursor")
+    return value, tiebreaker_value
+
+
+def ranked_landlords_query(sort_by, sort_direction):
+    return Landlord.query\
+        .outerjoin(LandlordScorecard, LandlordScorecard.group_id == Landlord.group_id)\
+        .add_entity(LandlordScorecard)\
+        .order_by(*get_ranking_order(sort_by, sort_direction))
+
+
+def get_ranked_landlord_dict(landlord, scorecard):
+    # Landlords without a scorecard yet come back with the same fields, set to None
+    ranked_landlord = scorecard.as_dict() if scorecard is not None else {column.name: None for column in LandlordScorecard.__table__.columns}
+    ranked_landlord.update(landlord.as_dict())
+    return ranked_landlord
+
+
+def get_ranked_landlords(sort_by, sort_direction, page_number, page_size):
+    results = ranked_landlords_query(sort_by, sort_direction).paginate(page_number, page_size)
+    landlord_list = [get_ranked_landlord_dict(landlord, scorecard) for landlord, scorecard in results.items]
     return PaginatedResults(landlord_list, results.total)
+
+
+def get_ranked_landlords_after(sort_by, sort_direction, cursor, page_size):
+    query = ranked_landlords_query(sort_by, sort_direction)
+
+    # The total only needs to be counted once, when a client starts walking the ranking
+    if cursor:
+        value, tiebreaker_value = decode_ranking_cursor(sort_by, sort_direction, cursor)
+        query = query.filter(get_ranking_keyset_filter(sort_by, sort_direction, value, tiebreaker_value))
+        total = None
+    else:
+        total = query.order_by(None).count()
+
+    # Fetch one extra row to find out whether there is another page
+    results = query.limit(page_size + 1).all()
+    landlord_list = [get_ranked_landlord_dict(landlord, scorecard) for landlord, scorecard in results[:page_size]]
+
+    next_cursor = None
+    if len(results) > page_size:
+        next_cursor = encode_ranking_cursor(sort_by, sort_direction, landlord_list[-1])
+
+    return PaginatedResults(landlord_list, total, next_cursor)